@@ -8,13 +8,102 @@ import os
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 
+# Only the subsystem needed by the chosen action is imported, after the
+# arguments are parsed: salt, jinja2 and yaml are slow to load.
 try:
-    from livecloud import deploy_salt
-    from livecloud import deploy_ceph
-    from livecloud import util
+    import livecloud  # noqa
 except ImportError:
-    sys.path.insert(0, os.path.abspath(
-        os.path.join(os.path.split(sys.argv[0])[0], "..")))
+    sys.path.insert(0, os.path.abspath(os.path.split(sys.argv[0])[0]))
+
+# modules imported by each action, checked by livecloud.bench startup
+ACTION_MODULES = {
+    'prepair': ['livecloud.deploy_salt'],
+    'deploy_minion': ['livecloud.deploy_salt', 'livecloud.batch'],
+    'bringup': ['livecloud.scheduler', 'livecloud.batch'],
+    'highstate': ['livecloud.deploy_ceph', 'livecloud.batch'],
+    'ntp': ['livecloud.deploy_ceph', 'livecloud.batch'],
+    'install': ['livecloud.deploy_ceph', 'livecloud.batch'],
+    'ceph': ['livecloud.deploy_ceph', 'livecloud.batch'],
+    'history': ['livecloud.history'],
+}
+
+HISTORY_QUERIES = ('slower', 'critical-path')
+
+PACKAGE_SLS = {
+    'ceph': 'ceph.ceph',
+    'kvm': 'ceph.kvm',
+}
+
+
+def get_parser():
+    program_description = "This is used for building ceph evn by saltstack"
+    parser = ArgumentParser(description=program_description,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "-p", "--prepair", dest="prepair", action="store_true",
+        help="generate prepair config in pillar [default: %(default)s]")
+    parser.add_argument(
+        "-d", "--deploy_minion", dest="interface",
+        help="deploy minion by nic ")
+    parser.add_argument(
+        "-s", "--highstate", dest="highstate", action="store_true",
+        help="set ceph node state.highstate [default: %(default)s]")
+    parser.add_argument(
+        "-n", "--ntp", dest="ntp", action="store_true",
+        help="set ntp state [default: %(default)s]")
+    parser.add_argument(
+        "-i", "--install", dest="package", choices=sorted(PACKAGE_SLS),
+        help="update 'ceph' or 'kvm'")
+    parser.add_argument(
+        "-c", "--ceph", dest="ceph", choices=['journal', 'mon', 'osd'],
+        help="deploy ceph 'journal' 'mon' 'osd'")
+    parser.add_argument(
+        "-b", "--bringup", dest="bringup", action="store_true",
+        help="run highstate, ntp, ceph, kvm and mon phases following "
+             "their dependencies per minion [default: %(default)s]")
+    parser.add_argument(
+        "--batch", dest="batch", type=int,
+        help="run on N minions per wave")
+    parser.add_argument(
+        "--batch-percent", dest="batch_percent", type=int,
+        help="run on this percentage of the minions per wave")
+    parser.add_argument(
+        "--max-in-flight", dest="max_in_flight", type=int,
+        help="keep at most N minions busy inside a wave")
+    parser.add_argument(
+        "--fail-threshold", dest="fail_threshold", type=int,
+        help="do not start further waves once N minions failed, "
+             "needs --batch or --batch-percent")
+    parser.add_argument(
+        "--ssh-workers", dest="ssh_workers", type=int,
+        help="hosts bootstrapped in parallel by salt-ssh [default: 25]")
+    parser.add_argument(
+        "--stream", dest="stream", action="store_true",
+        help="print each minion's return as soon as it arrives "
+             "[default: %(default)s]")
+    parser.add_argument(
+        "-o", "--output", dest="output", default="text",
+        choices=['text', 'json', 'ndjson'],
+        help="output format [default: %(default)s]")
+    parser.add_argument(
+        "--no-color", dest="color", action="store_false",
+        help="do not color the text output")
+    parser.add_argument(
+        "--history", dest="history", choices=HISTORY_QUERIES,
+        help="query the state timing history: 'slower' states or the "
+             "'critical-path' of the last highstate per node")
+    parser.add_argument(
+        "--history-days", dest="history_days", type=int, default=7,
+        help="compare the last N days with the N days before "
+             "[default: %(default)s]")
+    parser.add_argument(
+        "--history-db", dest="history_db",
+        help="state timing database [default: "
+             "/var/lib/livecloud/history.db]")
+    parser.add_argument(
+        "--no-history", dest="record_history", action="store_false",
+        help="do not record state timings of this run")
+    return parser
 
 
 def parser_arg(argv=None):
@@ -23,81 +112,99 @@ def parser_arg(argv=None):
     else:
         sys.argv.extend(argv)
 
-    program_description = "This is used for building ceph evn by saltstack"
     program_name = os.path.basename(sys.argv[0])
+    renderer = None
 
     try:
-        parser = ArgumentParser(description=program_description,
-                                formatter_class=RawDescriptionHelpFormatter)
-        parser.add_argument(
-            "-p", "--prepair", dest="prepair", action="store_true",
-            help="generate prepair config in pillar [default: %(default)s]")
-        parser.add_argument(
-            "-d", "--deploy_minion", dest="interface",
-            help="deploy minion by nic ")
-        parser.add_argument(
-            "-s", "--highstate", dest="highstate", action="store_true",
-            help="set ceph node state.highstate [default: %(default)s]")
-        parser.add_argument(
-            "-n", "--ntp", dest="ntp", action="store_true",
-            help="set ntp state [default: %(default)s]")
-        parser.add_argument(
-            "-i", "--install", dest="package",
-            help="update 'ceph' or 'kvm'")
-        parser.add_argument(
-            "-c", "--ceph", dest="ceph",
-            help="deploy ceph 'journal' 'mon' 'osd'")
+        parser = get_parser()
         # Process arguments
         args = parser.parse_args()
 
         if (not args.prepair and args.interface is None and
                 not args.highstate and not args.ntp and
-                args.package is None and args.ceph is None):
+                args.package is None and args.ceph is None and
+                not args.bringup and args.history is None):
             parser.print_help()
             sys.exit()
+        if args.fail_threshold is not None and not (args.batch or
+                                                    args.batch_percent):
+            # the threshold is checked between waves, without waves it
+            # would never stop anything
+            parser.error('--fail-threshold needs --batch or --batch-percent')
+
+        from livecloud import util
+        from livecloud import render
+        renderer = render.get_renderer(args.output, args.color)
+
+        if args.history:
+            from livecloud import history
+            if args.history_db:
+                history.set_database(args.history_db)
+            renderer.history(args.history,
+                             history.query(args.history, args.history_days),
+                             args.history_days)
+            return 0
 
         if args.prepair:
+            from livecloud import deploy_salt
             util.output_title('prepair livecloud env')
             deploy_salt.prepair_livecloud_conf()
             return 0
 
+        from livecloud import batch
+        from livecloud import history
+        policy = batch.policy_from_args(args)
+        history.set_database(None if not args.record_history else
+                             args.history_db or history.HISTORY_DB)
+
         if args.interface:
+            from livecloud import deploy_salt
             util.output_title('delpoy salt minion')
-            deploy_salt.deploy_salt_minion(args.interface)
+            deploy_salt.set_ssh_workers(args.ssh_workers)
+            deploy_salt.deploy_salt_minion(args.interface, policy=policy,
+                                           renderer=renderer)
             return 0
 
+        if args.bringup:
+            from livecloud import scheduler
+            util.output_title('Bring up cluster by salt')
+            ok = scheduler.bringup(policy=policy, renderer=renderer)
+            return 0 if ok else 1
+
+        from livecloud import deploy_ceph
+
         if args.highstate:
             util.output_title('Setting highstate by salt')
-            deploy_ceph.execute_salt_sls('state.highstate')
+            deploy_ceph.execute_salt_sls('state.highstate',
+                                         stream=args.stream, policy=policy,
+                                         renderer=renderer)
             return 0
 
         if args.ntp:
             util.output_title('Setting ntp state by salt')
-            deploy_ceph.execute_salt_sls('state.sls', ['ceph.ntp'])
+            deploy_ceph.execute_salt_sls('state.sls', ['ceph.ntp'],
+                                         stream=args.stream, policy=policy,
+                                         renderer=renderer)
             return 0
 
-        if args.package == 'ceph':
-            util.output_title('Update ceph packages')
-            deploy_ceph.execute_salt_sls('state.sls', ['ceph.ceph'])
-            return 0
-        elif args.package == 'kvm':
-            util.output_title('Update kvm packages')
-            deploy_ceph.execute_salt_sls('state.sls', ['ceph.kvm'])
+        if args.package:
+            util.output_title('Update %s packages' % args.package)
+            deploy_ceph.execute_salt_sls('state.sls',
+                                         [PACKAGE_SLS[args.package]],
+                                         stream=args.stream, policy=policy,
+                                         renderer=renderer)
             return 0
 
         if args.ceph == 'mon':
-            util.output_title('deploy mon by saltstack')
-            deploy_ceph.execute_salt_modules('ceph.mon')
-            return 0
-
-        if args.ceph == 'osd':
-            util.output_title('deploy osd by saltstack')
-            deploy_ceph.execute_salt_modules('ceph.osd')
-            return 0
-
-        if args.ceph == 'journal':
-            util.output_title('deploy journal by saltstack')
-            deploy_ceph.execute_salt_modules('ceph.journal')
+            util.output_title('bootstrap mons by saltstack')
+            started = deploy_ceph.bootstrap_mons(renderer=renderer)
+            return 0 if started and all(started.values()) else 1
+
+        if args.ceph:
+            util.output_title('deploy %s by saltstack' % args.ceph)
+            deploy_ceph.execute_salt_modules('ceph.%s' % args.ceph,
+                                             stream=args.stream, policy=policy,
+                                             renderer=renderer)
             return 0
 
         return 0
@@ -108,7 +215,14 @@ def parser_arg(argv=None):
         sys.stderr.write(program_name + ": " + repr(e) + "\n")
         sys.stderr.write(indent + "  for help use --help\n")
         return 2
+    finally:
+        if renderer is not None:
+            renderer.close()
+        clients = sys.modules.get('livecloud.clients')
+        if clients is not None and clients.report():
+            from livecloud import util
+            util.message(util.printable_clients(clients.report()))
 
 
 if __name__ == '__main__':
-    parser_arg()
+    sys.exit(parser_arg())
@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+
+import math
+from multiprocessing.pool import ThreadPool
+
+from livecloud import util
+
+
+def return_succeeded(command, ret, retcode=0):
+    """
+    Tell whether a minion return of a salt function succeeded.
+    """
+    if retcode:
+        return False
+    if command.startswith('state.'):
+        if not isinstance(ret, dict) or not ret:
+            return False
+        return all(isinstance(state, dict) and state.get('result') is not False
+                   for state in ret.values())
+    if isinstance(ret, list):
+        return all(return_succeeded(command, item) for item in ret)
+    if isinstance(ret, dict) and 'result' in ret:
+        return bool(ret['result'])
+    return ret is not False and ret is not None
+
+
+class BatchPolicy(object):
+    """
+    Split targets into waves of ``size`` minions (or ``percent`` of them),
+    optionally keeping at most ``max_in_flight`` minions busy inside a wave.
+    Later waves are not started once ``fail_threshold`` minions failed.
+    """
+
+    def __init__(self, size=None, percent=None, max_in_flight=None,
+                 fail_threshold=None):
+        self.size = size
+        self.percent = percent
+        self.max_in_flight = max_in_flight
+        self.fail_threshold = fail_threshold
+
+    def wave_size(self, total):
+        if self.size:
+            size = self.size
+        elif self.percent:
+            size = int(math.ceil(total * self.percent / 100.0))
+        else:
+            size = total
+        return max(min(size, total), 1)
+
+    def waves(self, targets):
+        targets = list(targets)
+        size = self.wave_size(len(targets))
+        return [targets[i:i + size] for i in range(0, len(targets), size)]
+
+    def exceeded(self, failed):
+        if self.fail_threshold is None:
+            return False
+        return failed >= self.fail_threshold
+
+    def _run_wave(self, wave, run_target, pool):
+        if pool is None or self.max_in_flight >= len(wave):
+            return run_target(wave)
+        # sliding window: a new minion starts as soon as one finishes
+        finished = pool.imap_unordered(
+            lambda minion: list(run_target([minion])), wave)
+        return (item for results in finished for item in results)
+
+    def run(self, targets, run_target, command, succeeded=None):
+        """
+        Run ``run_target(minion_list)`` wave by wave. It must yield
+        (minion, return, retcode); the same triples are yielded back.
+        ``succeeded`` defaults to return_succeeded.
+        """
+        succeeded = succeeded or return_succeeded
+        failed = 0
+        waves = self.waves(targets)
+        # one pool serves every wave, its threads are joined at the end
+        pool = None
+        if self.max_in_flight and any(len(wave) > self.max_in_flight
+                                      for wave in waves):
+            pool = ThreadPool(self.max_in_flight)
+        try:
+            for index, wave in enumerate(waves):
+                util.log_screen('wave %d/%d: %d minions' %
+                                (index + 1, len(waves), len(wave)))
+                returned = set()
+                for minion, ret, retcode in self._run_wave(wave, run_target,
+                                                           pool):
+                    returned.add(minion)
+                    if not succeeded(command, ret, retcode):
+                        failed += 1
+                    yield minion, ret, retcode
+                for minion in sorted(set(wave) - returned):
+                    failed += 1
+                    yield minion, 'Minion did not return', 1
+
+                if self.exceeded(failed) and index + 1 < len(waves):
+                    skipped = sum(len(rest) for rest in waves[index + 1:])
+                    util.message(util.colored_red(
+                        '==> %d minions failed, stop before the remaining '
+                        '%d minions' % (failed, skipped)))
+                    return
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+def policy_from_args(args):
+    if not (args.batch or args.batch_percent or args.max_in_flight):
+        return None
+    return BatchPolicy(size=args.batch, percent=args.batch_percent,
+                       max_in_flight=args.max_in_flight,
+                       fail_threshold=args.fail_threshold)
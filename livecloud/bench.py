@@ -0,0 +1,274 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+'''
+Micro benchmarks, run them from the top of the repository:
+    python -m livecloud.bench startup [--repeat N] [--max-ms MS]
+    python -m livecloud.bench render [--minions N] [--states N]
+'''
+
+import os
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+IMPORT_SNIPPET = '''import sys, time
+start = time.time()
+import deploy
+for name in sys.argv[1:]:
+    __import__(name)
+sys.stdout.write('%f' % (time.time() - start))
+'''
+
+
+def _best_of(repeat, func):
+    return min(func() for _ in range(repeat))
+
+
+def _time_help():
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, 'deploy.py', '--help'],
+                              cwd=ROOT_DIR, stdout=devnull)
+    return (time.time() - start) * 1000
+
+
+def _time_imports(modules):
+    out = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SNIPPET] + list(modules),
+        cwd=ROOT_DIR, stderr=subprocess.STDOUT)
+    return float(out) * 1000
+
+
+def bench_startup(repeat=3):
+    '''
+    Return (name, milliseconds or None) for ``deploy.py --help`` and for
+    the imports of every action, each measured in a fresh interpreter.
+    '''
+    sys.path.insert(0, ROOT_DIR)
+    import deploy
+
+    rows = [('--help (wall)', _best_of(repeat, _time_help))]
+    for action in sorted(deploy.ACTION_MODULES):
+        modules = deploy.ACTION_MODULES[action]
+        try:
+            cost = _best_of(repeat, lambda: _time_imports(modules))
+        except subprocess.CalledProcessError:
+            cost = None
+        rows.append((action, cost))
+    return rows
+
+
+def synthetic_highstate(minions=500, states=60):
+    '''
+    A LocalClient state.highstate return shaped like a real cluster run.
+    '''
+    functions = [('pkg', 'installed'), ('file', 'managed'),
+                 ('service', 'running'), ('cmd', 'run')]
+    data = {}
+    for index in range(minions):
+        ret = {}
+        for number in range(states):
+            mod, fun = functions[number % len(functions)]
+            key = '{0}_|-state_{1}_|-/etc/livecloud/{1}_|-{2}'.format(
+                mod, number, fun)
+            ret[key] = {
+                '__run_num__': number,
+                'result': (index + number) % 97 != 0,
+                'comment': 'File /etc/livecloud/%d is in the correct state' %
+                           number,
+                'changes': {'diff': 'New file'} if number % 10 == 0 else {},
+                'start_time': '10:%02d:%02d.000000' % (number % 60,
+                                                       index % 60),
+                'duration': float(number % 13) * 3.7,
+            }
+        data['node%03d' % index] = ret
+    return data
+
+
+class Sink(object):
+    '''
+    Discard output, remembering when it started and the largest write.
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.first = None
+        self.largest = 0
+        self.size = 0
+
+    def write(self, text):
+        if self.first is None:
+            self.first = time.time() - self.start
+        self.largest = max(self.largest, len(text))
+        self.size += len(text)
+
+    def flush(self):
+        pass
+
+
+def _baseline_parse(data):
+    # the dict-of-lists parser of deploy_ceph.parse_from_state before the
+    # StateRecord rewrite, kept to compare the renderers against
+    final_dict = dict()
+    for key in data:
+        new_list = list()
+        succ = 0
+        fail = 0
+        for data_key, data_value in data[key].items():
+            func_left, myid, myname, func_right = data_key.split('_|-')
+            new_list.append({
+                'len': len(key) + 1, 'id': myid,
+                'function': func_left + '.' + func_right, 'name': myname,
+                'number': data_value['__run_num__'],
+                'result': data_value['result'],
+                'comment': data_value['comment'].strip(),
+                'changes': data_value.get('changes') or '',
+                'start': data_value.get('start_time', ''),
+                'duration': '%s ms' % data_value['duration']
+                            if 'duration' in data_value else '',
+            })
+            if data_value['result']:
+                succ += 1
+            else:
+                fail += 1
+        final_dict['%s:' % key] = {'values': new_list, 'succ': succ,
+                                   'fail': fail}
+    return final_dict
+
+
+def _baseline_obj(util, obj):
+    output_list = list()
+    output_list.append('-' * obj["len"])
+    output_list.append('{:>12}: {}'.format("ID", obj["id"]))
+    output_list.append('{:>12}: {}'.format("Function", obj["function"]))
+    output_list.append('{:>12}: {}'.format("Name", obj["name"]))
+    output_list.append('{:>12}: {}'.format("Result", obj["result"]))
+    new_comment = ('\n' + ' ' * 14).join(obj["comment"].split('\n'))
+    output_list.append('{:>12}: {}'.format("Comment", new_comment))
+    output_list.append('{:>12}: {}'.format("Started", obj["start"]))
+    output_list.append('{:>12}: {}'.format("Duration", obj["duration"]))
+    changes = util.output_changes(obj["changes"]) if obj["changes"] else ''
+    output_list.append('{:>12}: {}'.format("Changes", changes))
+    buf = '\n'.join(output_list)
+    if obj["result"]:
+        return util.colored_green(buf)
+    return util.colored_red(buf)
+
+
+def _baseline_pretty_output_sls(util, data):
+    # the list-joining util.pretty_output_sls before the streaming renderers
+    final_data = _baseline_parse(data)
+    output_list = list()
+    for key in final_data:
+        if final_data[key]['fail'] == 0:
+            output_list.append(util.colored_green(key))
+        else:
+            output_list.append(util.colored_red(key))
+        values = sorted(final_data[key]['values'], key=lambda x: x['number'])
+        for obj in values:
+            output_list.append(_baseline_obj(util, obj))
+        output_list.append(util.printable_summary(final_data[key]['succ'],
+                                                  final_data[key]['fail']))
+    print('\n'.join(output_list))
+
+
+def _bench_legacy(data):
+    from livecloud import util
+    sink = Sink()
+    stdout, sys.stdout = sys.stdout, sink
+    try:
+        _baseline_pretty_output_sls(util, data)
+    finally:
+        sys.stdout = stdout
+    return sink
+
+
+def _bench_renderer(output, color, data):
+    from livecloud import render
+    from livecloud import util
+    sink = Sink()
+    renderer = render.get_renderer(output, color, sink)
+    try:
+        renderer.returns(data)
+        renderer.close()
+    finally:
+        util.set_color(True)
+        util.set_message_stream(None)
+    return sink
+
+
+def bench_render(minions=500, states=60):
+    '''
+    Return (name, total ms, first byte ms, largest write) of the original
+    list-joining renderer and of the streaming renderers.
+    '''
+    sys.path.insert(0, ROOT_DIR)
+    data = synthetic_highstate(minions, states)
+    cases = [
+        ('baseline', lambda: _bench_legacy(data)),
+        ('text', lambda: _bench_renderer('text', True, data)),
+        ('text --no-color', lambda: _bench_renderer('text', False, data)),
+        ('json', lambda: _bench_renderer('json', False, data)),
+        ('ndjson', lambda: _bench_renderer('ndjson', False, data)),
+    ]
+    rows = []
+    for name, run in cases:
+        start = time.time()
+        sink = run()
+        total = (time.time() - start) * 1000
+        rows.append((name, total, (sink.first or 0) * 1000, sink.largest))
+    return rows
+
+
+def print_rows(title, rows):
+    print title
+    print '-' * 40
+    for name, cost in rows:
+        if cost is None:
+            print '{0:<24} {1:>12}'.format(name, 'import failed')
+        else:
+            print '{0:<24} {1:>9.1f} ms'.format(name, cost)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='livecloud micro benchmarks')
+    subparsers = parser.add_subparsers(dest='bench')
+    startup = subparsers.add_parser(
+        'startup', help='import cost of deploy.py per action')
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--max-ms', type=float,
+                         help='fail when an action exceeds this budget')
+    render = subparsers.add_parser(
+        'render', help='state output renderers on a synthetic highstate')
+    render.add_argument('--minions', type=int, default=500)
+    render.add_argument('--states', type=int, default=60)
+    args = parser.parse_args(argv)
+
+    if args.bench == 'startup':
+        rows = bench_startup(args.repeat)
+        print_rows('deploy.py startup', rows)
+        if args.max_ms is not None:
+            over = [name for name, cost in rows
+                    if cost is None or cost > args.max_ms]
+            if over:
+                print 'over %.1f ms: %s' % (args.max_ms, ', '.join(over))
+                return 1
+    elif args.bench == 'render':
+        rows = bench_render(args.minions, args.states)
+        print '%d minions x %d states' % (args.minions, args.states)
+        print '-' * 64
+        print '{0:<20} {1:>10} {2:>14} {3:>16}'.format(
+            'renderer', 'total', 'first byte', 'largest write')
+        for name, total, first, largest in rows:
+            print '{0:<20} {1:>7.1f} ms {2:>11.1f} ms {3:>10d} bytes'.format(
+                name, total, first, largest)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
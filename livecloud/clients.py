@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+
+import time
+import threading
+from collections import OrderedDict
+
+
+def _new_local_client():
+    import salt.client
+    return salt.client.LocalClient()
+
+
+def _new_ssh_client():
+    from salt.client.ssh.client import SSHClient
+    return SSHClient()
+
+
+FACTORIES = {
+    'local': _new_local_client,
+    'ssh': _new_ssh_client,
+}
+
+
+class ClientManager(object):
+    """
+    Create each salt client lazily once and hand the same instance to every
+    phase of the process. Clients are kept per thread because a LocalClient
+    event bus must not be read from two threads at once.
+    """
+
+    def __init__(self):
+        self._clients = threading.local()
+        self._lock = threading.Lock()
+        self.costs = {}
+        self.phases = OrderedDict()
+
+    def get(self, kind, phase=None):
+        client = getattr(self._clients, kind, None)
+        created = client is None
+        if created:
+            start = time.time()
+            client = FACTORIES[kind]()
+            setattr(self._clients, kind, client)
+            cost = time.time() - start
+        with self._lock:
+            if created:
+                self.costs.setdefault(kind, []).append(cost)
+            stats = self.phases.setdefault((phase or '-', kind),
+                                           {'requests': 0, 'created': 0})
+            stats['requests'] += 1
+            stats['created'] += int(created)
+        return client
+
+    def average_cost(self, kind):
+        costs = self.costs.get(kind)
+        return sum(costs) / len(costs) if costs else 0.0
+
+    def report(self):
+        """
+        Return (phase, kind, requests, created, saved seconds) for every
+        phase, the saving being the average setup cost of each reuse.
+        """
+        rows = []
+        for (phase, kind), stats in self.phases.items():
+            reused = stats['requests'] - stats['created']
+            rows.append((phase, kind, stats['requests'], stats['created'],
+                         reused * self.average_cost(kind)))
+        return rows
+
+
+_manager = ClientManager()
+
+
+def local_client(phase=None):
+    return _manager.get('local', phase)
+
+
+def ssh_client(phase=None):
+    return _manager.get('ssh', phase)
+
+
+def report():
+    return _manager.report()
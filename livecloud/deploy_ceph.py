@@ -5,8 +5,13 @@
 #
 # @author: david_dong
 
-import salt.client
 from livecloud import util
+from livecloud import states
+from livecloud import clients
+from livecloud import render
+from livecloud import batch
+from livecloud import summary
+from livecloud import history
 
 
 LIVECLOUD_CONF = '/etc/salt/master.d'
@@ -15,72 +20,125 @@ SSH_CONF = '/root/.ssh'
 HOST_CONF = '/etc/hosts'
 
 
-def parse_from_state(jsondict):
-    final_dict = dict()
-    for key in jsondict:
-        temp_dict = dict()
-        final_key = '%s:' % key
-        data_dict = jsondict[key]
-        new_list = list()
-        succ = 0
-        fail = 0
-        for data_key in data_dict:
-            new_obj = dict()
-            new_obj['len'] = len(key) + 1
-            func_left, myid, myname, func_right = data_key.split('_|-')
-            new_obj['id'] = myid
-            new_obj['function'] = func_left + '.' + func_right
-            new_obj['name'] = myname
-            data_value = data_dict[data_key]
-            new_obj['number'] = data_value['__run_num__']
-
-            new_obj['result'] = data_value['result']
-            if data_value['result']:
-                succ += 1
-            else:
-                fail += 1
-
-            new_obj['comment'] = data_value['comment'].strip()
-
-            if 'changes' in data_value and data_value['changes']:
-                new_obj['changes'] = data_value['changes']
-            else:
-                new_obj['changes'] = ''
-
-            if 'start_time' in data_value:
-                new_obj['start'] = data_value['start_time']
-            else:
-                new_obj['start'] = ''
-
-            if 'duration' in data_value:
-                new_obj['duration'] = '%s ms' % data_value['duration']
-            else:
-                new_obj['duration'] = ''
-            new_list.append(new_obj)
-            temp_dict['values'] = new_list
-            temp_dict['succ'] = succ
-            temp_dict['fail'] = fail
-
-        final_dict[final_key] = temp_dict
-    return final_dict
-
-
-def execute_salt_cmd(arg=()):
-    local = salt.client.LocalClient()
-    result = local.cmd(tgt='*', fun='cmd.run', arg=arg)
-    util.pretty_output_cmd(result)
-
-
-def execute_salt_sls(command, arg=()):
-    local = salt.client.LocalClient()
-    result = local.cmd(tgt='*', fun=command, arg=arg)
-    util.pretty_output_sls(parse_from_state, result)
-
-
-def execute_salt_modules(command, arg=()):
-    local = salt.client.LocalClient()
-    result = local.cmd(tgt='*', fun=command, arg=arg)
-    print '\n'.join(util.display(result, 0, '', []))
+def list_minions():
+    local = clients.local_client('test.ping')
+    return sorted(local.cmd(tgt='*', fun='test.ping'))
+
+
+def _local_returns(tgt, command, arg=()):
+    local = clients.local_client(command)
+    expr_form = 'list' if isinstance(tgt, list) else 'glob'
+    for chunk in local.cmd_iter(tgt=tgt, fun=command, arg=arg,
+                                expr_form=expr_form):
+        for minion, data in chunk.items():
+            yield minion, data.get('ret'), data.get('retcode', 0)
+
+
+def iter_salt_returns(command, arg=(), policy=None):
+    """
+    Yield (minion, return, retcode) as soon as each minion answers, wave by
+    wave when a batch policy is given.
+    """
+    if policy is None:
+        return _local_returns('*', command, arg)
+    return policy.run(list_minions(),
+                      lambda tgt: _local_returns(tgt, command, arg), command)
+
+
+def execute_salt_cmd(arg=(), stream=False, policy=None, renderer=None):
+    renderer = renderer or render.TextRenderer()
+    if not stream and policy is None:
+        local = clients.local_client('cmd.run')
+        result = local.cmd(tgt='*', fun='cmd.run', arg=arg)
+        for minion in result:
+            renderer.command(minion, result[minion])
+    else:
+        for minion, ret, _ in iter_salt_returns('cmd.run', arg, policy):
+            renderer.command(minion, ret)
+
+
+def execute_salt_sls(command, arg=(), stream=False, policy=None,
+                     renderer=None):
+    renderer = renderer or render.TextRenderer()
+    cluster = summary.ClusterSummary(
+        recorder=history.recorder(command, arg))
+    if not stream and policy is None:
+        local = clients.local_client(command)
+        result = local.cmd(tgt='*', fun=command, arg=arg)
+        renderer.summary(renderer.returns(result, cluster))
+        return
+    for minion, ret, _ in iter_salt_returns(command, arg, policy):
+        host = states.parse_host(minion, ret)
+        renderer.host(minion, host, ret)
+        if host is None:
+            cluster.add_failure(minion)
+        else:
+            cluster.add(host)
+        renderer.progress(cluster.minions, cluster.succ, cluster.fail)
+    renderer.summary(cluster)
+
+
+def execute_salt_modules(command, arg=(), stream=False, policy=None,
+                         renderer=None):
+    renderer = renderer or render.TextRenderer()
+    if not stream and policy is None:
+        local = clients.local_client(command)
+        result = local.cmd(tgt='*', fun=command, arg=arg)
+        for minion in sorted(result):
+            renderer.value(minion, result[minion])
+    else:
+        for minion, ret, _ in iter_salt_returns(command, arg, policy):
+            renderer.value(minion, ret)
+
+
+def list_mons():
+    local = clients.local_client('test.ping')
+    return sorted(local.cmd(tgt='roles:ceph-mon', fun='test.ping',
+                            expr_form='grain'))
+
+
+def bootstrap_mons(renderer=None, mons=None):
+    """
+    Build the monmap and ceph.conf once on the first monitor and hand them
+    to all monitors in a single job, which mkfs and start every monitor
+    at the same time. Return {mon: True when it started}.
+    """
+    renderer = renderer or render.TextRenderer()
+    mons = sorted(mons or list_mons())
+    if not mons:
+        util.message(util.colored_red('==> no minion with role ceph-mon'))
+        return {}
+
+    local = clients.local_client('ceph.monmap')
+    seed = local.cmd(tgt=mons[0], fun='ceph.monmap').get(mons[0])
+    if not isinstance(seed, dict) or 'minions' not in seed:
+        renderer.value(mons[0], seed)
+        return dict((mon, False) for mon in mons)
+    # the monmap comes from the mine, the targets from the grains: a
+    # monitor missing from the map would never join the quorum
+    if set(seed['minions']) != set(mons):
+        util.message(util.colored_red(
+            '==> monmap of %s does not match the ceph-mon minions %s, '
+            'check the mine (ceph.mon_addr)' %
+            (', '.join(seed['minions']), ', '.join(mons))))
+        return dict((mon, False) for mon in mons)
+    util.log_screen('monmap of %s built on %s' % (', '.join(seed['mons']),
+                                                  mons[0]))
+
+    results = {}
+    kwarg = {'monmap': seed['monmap'], 'conf': seed['conf']}
+    local = clients.local_client('ceph.mon_bootstrap')
+    for chunk in local.cmd_iter(tgt=mons, fun='ceph.mon_bootstrap',
+                                kwarg=kwarg, expr_form='list'):
+        for minion, data in chunk.items():
+            ret = data.get('ret')
+            renderer.value(minion, ret)
+            results[minion] = batch.return_succeeded(
+                'ceph.mon_bootstrap', ret, data.get('retcode', 0))
+    for minion in sorted(set(mons) - set(results)):
+        renderer.value(minion, 'Minion did not return')
+        results[minion] = False
+    return results
 
 
 def operate_salt_minion():
@@ -93,7 +151,7 @@ def operate_salt_minion():
     util.output_title('salt kvm state')
     execute_salt_sls('state.sls', ['ceph.kvm'])
     util.output_title('salt livecloud mon')
-    execute_salt_modules('ceph.mon')
+    bootstrap_mons()
 
 
 def main():
@@ -4,20 +4,53 @@
 
 import os
 import re
+import time
 import yaml
 import jinja2
 from livecloud import util
-
-from salt.client.ssh.client import SSHClient
+from livecloud import batch
+from livecloud import clients
+from livecloud import render
+from livecloud import summary
+from livecloud import history
 
 
 LIVECLOUD_CONF = '/etc/salt/master.d'
 LIVECLOUD_ROSTER = '/etc/salt/roster'
 SSH_CONF = '/root/.ssh'
 HOST_CONF = '/etc/hosts'
+PILLAR_NODES = 'nodes'
+# entries of nodes in ceph.yml read by every minion, not hosts
+SHARED_NODE_KEYS = ('master', 'ntp')
+SSH_WORKERS = 25
+
+# options given to every salt-ssh job: number of hosts run in parallel
+SSH_OPTS = {'ssh_max_procs': SSH_WORKERS}
+
+
+def set_ssh_workers(workers):
+    SSH_OPTS['ssh_max_procs'] = workers or SSH_WORKERS
+
+
+# libyaml bindings parse and dump several times faster when available
+try:
+    from yaml import CSafeLoader as YamlLoader
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+    from yaml import SafeDumper as YamlDumper
+
+
+_root_dir = None
+_template_env = None
+# path -> (mtime, size, parsed data)
+_yaml_cache = {}
 
 
 def get_root_dir():
+    global _root_dir
+    if _root_dir is not None:
+        return _root_dir
     current_path = os.path.dirname(os.path.realpath(__file__))
     pattern = re.compile(r'\livecloud\S*')
     found = re.findall(pattern, current_path)
@@ -25,89 +58,126 @@ def get_root_dir():
 
     if found is not None:
         root_dir = re.sub(pattern, '', current_path)
+    _root_dir = root_dir
     return root_dir
 
 
+def get_template_env():
+    '''
+    One environment per process, so each template is compiled once, backed
+    by a bytecode cache in the temp dir which later runs load instead of
+    parsing the templates again.
+    '''
+    global _template_env
+    if _template_env is None:
+        template_path = os.path.join(get_root_dir(), 'templates')
+        _template_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_path),
+            bytecode_cache=jinja2.FileSystemBytecodeCache())
+    return _template_env
+
+
 def render_template(tempate_name, dest_file, **context):
-    template_path = os.path.join(get_root_dir(), 'templates')
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path))
-    template = env.get_template(tempate_name)
-    with open(dest_file, "wb") as f:
-        f.write(template.render(**context))
+    '''
+    Return True when dest_file changed.
+    '''
+    template = get_template_env().get_template(tempate_name)
+    return util.write_if_changed(dest_file, template.render(**context))
 
 
 def write_yaml_from_cfg(data, yaml_file):
-    with open(yaml_file, "w+") as yaml_f:
-        yaml.safe_dump(data, yaml_f, allow_unicode=True)
+    return util.write_if_changed(
+        yaml_file, yaml.dump(data, Dumper=YamlDumper, allow_unicode=True))
 
 
-def get_yaml_from_cfg(yaml_file):
-    yaml_file = os.path.join(get_root_dir(), 'conf', yaml_file)
-    with open(yaml_file) as yaml_f:
-        yaml_data = yaml.load(yaml_f)
+def load_yaml(path):
+    '''
+    Parse a yaml file once per content: the result is cached by path and
+    reused until the file's mtime or size changes. Callers must copy
+    before modifying it.
+    '''
+    stat = os.stat(path)
+    cached = _yaml_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    with open(path) as yaml_f:
+        yaml_data = yaml.load(yaml_f, Loader=YamlLoader)
+    _yaml_cache[path] = (stat.st_mtime, stat.st_size, yaml_data)
     return yaml_data
 
 
+def get_yaml_from_cfg(yaml_file):
+    return load_yaml(os.path.join(get_root_dir(), 'conf', yaml_file))
+
+
+def split_pillar(data):
+    '''
+    Split ceph.yml into the pillar shared by every minion (ceph:* plus the
+    master and ntp entries of nodes) and one shard per node holding only
+    nodes:<host>, so no minion receives the inventory of the others.
+    '''
+    nodes = data.get('nodes') or {}
+    shared = dict((key, value) for key, value in data.items()
+                  if key != 'nodes')
+    shared['nodes'] = dict((key, nodes[key]) for key in SHARED_NODE_KEYS
+                           if key in nodes)
+    shards = dict((host, {'nodes': {host: conf}})
+                  for host, conf in nodes.items()
+                  if host not in SHARED_NODE_KEYS)
+    return shared, shards
+
+
+def _shard_sls(host):
+    # dots would be read as sls directories
+    return host.replace('.', '_')
+
+
+def _write_pillar_file(data, dest_file, written):
+    written[dest_file] = write_yaml_from_cfg(data, dest_file)
+    util.log_written(dest_file, written[dest_file])
+
+
 def write_ceph_pillar(default='ceph.sls'):
-    dest_file = os.path.join(get_root_dir(), 'pillar', default)
-    write_yaml_from_cfg(get_yaml_from_cfg('ceph.yml'), dest_file)
-    util.log_screen('Generate in %s\n' % dest_file)
-
-
-def parse_from_dict(jsondict):
-    final_dict = dict()
-    for key in jsondict:
-        temp_dict = dict()
-        final_key = '%s:' % key
-        if 'return' in jsondict[key]:
-            return_dict = jsondict[key]['return']
-            new_list = list()
-            succ = 0
-            fail = 0
-            for return_key in return_dict:
-                new_obj = dict()
-                new_obj['len'] = len(key) + 1
-                func_left, myid, myname, func_right = return_key.split('_|-')
-                new_obj['id'] = myid
-                new_obj['function'] = func_left + '.' + func_right
-                new_obj['name'] = myname
-                return_value = return_dict[return_key]
-                new_obj['number'] = return_value['__run_num__']
-
-                new_obj['result'] = return_value['result']
-                if return_value['result']:
-                    succ += 1
-                else:
-                    fail += 1
-
-                new_obj['comment'] = return_value['comment'].strip()
-
-                if 'changes' in return_value and return_value['changes']:
-                    new_obj['changes'] = return_value['changes']
-                else:
-                    new_obj['changes'] = ''
-
-                if 'start_time' in return_value:
-                    new_obj['start'] = return_value['start_time']
-                else:
-                    new_obj['start'] = ''
-
-                if 'duration' in return_value:
-                    new_obj['duration'] = '%s ms' % return_value['duration']
-                else:
-                    new_obj['duration'] = ''
-                new_list.append(new_obj)
-            temp_dict['values'] = new_list
-            temp_dict['succ'] = succ
-            temp_dict['fail'] = fail
-
-        final_dict[final_key] = temp_dict
-    return final_dict
+    '''
+    Write the shared pillar, pillar/nodes/<host>.sls for every node and a
+    top.sls mapping each minion to its own shard, removing the shards of
+    nodes no longer in ceph.yml. Return {path: changed}.
+
+    Shards are targeted by the host grain, the name the ceph module looks
+    itself up with, so minion ids need not match the ceph.yml keys.
+    '''
+    pillar_dir = os.path.join(get_root_dir(), 'pillar')
+    nodes_dir = os.path.join(pillar_dir, PILLAR_NODES)
+    if not os.path.exists(nodes_dir):
+        os.mkdir(nodes_dir)
+    shared, shards = split_pillar(get_yaml_from_cfg('ceph.yml'))
+    written = {}
+    _write_pillar_file(shared, os.path.join(pillar_dir, default), written)
+
+    top = {'*': ['mine', os.path.splitext(default)[0]]}
+    shard_files = set()
+    for host in sorted(shards):
+        sls = _shard_sls(host)
+        shard_files.add('%s.sls' % sls)
+        _write_pillar_file(shards[host],
+                           os.path.join(nodes_dir, '%s.sls' % sls), written)
+        top['host:%s' % host] = [{'match': 'grain'},
+                                 '%s.%s' % (PILLAR_NODES, sls)]
+    _write_pillar_file({'base': top}, os.path.join(pillar_dir, 'top.sls'),
+                       written)
+
+    for name in os.listdir(nodes_dir):
+        if name.endswith('.sls') and name not in shard_files:
+            os.remove(os.path.join(nodes_dir, name))
+            util.log_screen('%s removed' % os.path.join(nodes_dir, name))
+    return written
 
 
 def prepair_livecloud_conf():
     '''
     params: fsid, public_network, cluster_network host_ips
+    Return {path: changed} of every generated file, unchanged files are
+    left untouched so the states watching them do not restart anything.
     '''
     if not os.path.exists(LIVECLOUD_CONF):
         os.mkdir(LIVECLOUD_CONF)
@@ -116,38 +186,74 @@ def prepair_livecloud_conf():
         os.mkdir(SSH_CONF)
     ssh_conf = os.path.join(SSH_CONF, 'config')
     master_conf = get_yaml_from_cfg('master.yml')
-    context = master_conf
+    context = dict(master_conf)
     context.update({'base_dir': get_root_dir()})
-    render_template('livecloud.tmpl', livecloud_conf, **context)
-    util.log_screen('write livecloud.conf successful')
-    host_ips = master_conf['nodes']
-    context.update({'host_ips': host_ips})
-    render_template('roster.tmpl', LIVECLOUD_ROSTER, **context)
-    util.log_screen('write roster successful')
-    host_ips = master_conf['nodes']
-    context.update({'host_ips': host_ips})
-    render_template('ssh.tmpl', ssh_conf, **context)
-    util.log_screen('write ssh.conf successful')
-    host_ips = master_conf['nodes']
-    context.update({'host_ips': host_ips})
-    render_template('hosts.tmpl', HOST_CONF, **context)
-    util.log_screen('write hosts successful')
-    write_ceph_pillar()
-
-
-def execute_salt_ssh(arg=()):
-    client = SSHClient()
-    result = client.cmd(tgt='*', fun='cmd.run', arg=arg)
-    util.pretty_output_ssh(result)
-
-
-def execute_salt_sls(command, arg=()):
-    client = SSHClient()
-    result = client.cmd(tgt='*', fun=command, arg=arg)
-    util.pretty_output_sls(parse_from_dict, result)
-
-
-def deploy_salt_minion(nic):
+    context.update({'host_ips': master_conf['nodes']})
+    written = {}
+    for template, dest_file in (('livecloud.tmpl', livecloud_conf),
+                                ('roster.tmpl', LIVECLOUD_ROSTER),
+                                ('ssh.tmpl', ssh_conf),
+                                ('hosts.tmpl', HOST_CONF)):
+        written[dest_file] = render_template(template, dest_file, **context)
+        util.log_written(dest_file, written[dest_file])
+    written.update(write_ceph_pillar())
+    return written
+
+
+def list_roster_targets():
+    return sorted(load_yaml(LIVECLOUD_ROSTER) or {})
+
+
+def _ssh_returns(tgt, command, arg=(), timings=None):
+    client = clients.ssh_client(command)
+    expr_form = 'list' if isinstance(tgt, list) else 'glob'
+    start = time.time()
+    for chunk in client.cmd_iter(tgt=tgt, fun=command, arg=arg,
+                                 expr_form=expr_form, **SSH_OPTS):
+        for host, data in chunk.items():
+            # salt-ssh does not tell when a host got one of the
+            # ssh_max_procs slots, so this is the time the host returned
+            # after the job started, its wait for a slot included
+            if timings is not None:
+                timings.setdefault(host, {})[command] = time.time() - start
+            retcode = data.get('retcode', 0) if isinstance(data, dict) else 1
+            yield host, data, retcode
+
+
+def _ssh_succeeded(command, data, retcode=0):
+    ret = data.get('return') if isinstance(data, dict) else data
+    return batch.return_succeeded(command, ret, retcode)
+
+
+def iter_ssh_returns(command, arg=(), policy=None, timings=None):
+    '''
+    Yield (host, data, retcode) as each host finishes. ``timings`` collects
+    {host: {command: seconds from the start of the job to the return}}.
+    '''
+    if policy is None:
+        return _ssh_returns('*', command, arg, timings)
+    return policy.run(list_roster_targets(),
+                      lambda tgt: _ssh_returns(tgt, command, arg, timings),
+                      command, succeeded=_ssh_succeeded)
+
+
+def execute_salt_ssh(arg=(), policy=None, renderer=None, timings=None):
+    renderer = renderer or render.TextRenderer()
+    for host, data, _ in iter_ssh_returns('cmd.run', arg, policy, timings):
+        renderer.ssh(host, data)
+
+
+def execute_salt_sls(command, arg=(), policy=None, renderer=None,
+                     timings=None):
+    renderer = renderer or render.TextRenderer()
+    cluster = summary.ClusterSummary(
+        recorder=history.recorder(command, arg))
+    for host, data, _ in iter_ssh_returns(command, arg, policy, timings):
+        renderer.returns({host: data}, cluster)
+    renderer.summary(cluster)
+
+
+def deploy_salt_minion(nic, policy=None, renderer=None):
     ipaddr = util.get_local_ipaddr(nic)[0]
     hostname = util.resolve_ip()
     cmd = 'echo "%s %s" >> /etc/hosts;' % (ipaddr, hostname)
@@ -157,8 +263,13 @@ def deploy_salt_minion(nic):
     cmd += 'echo "enabled=1" >> /etc/yum.repos.d/yum.repo;'
     cmd += 'echo "gpgcheck=0" >> /etc/yum.repos.d/yum.repo;'
     cmd += 'yum --disablerepo=\* --enablerepo=yum install -y yum-utils;'
-    execute_salt_ssh(arg=[cmd])
-    execute_salt_sls('state.sls', ['ceph.minion'])
+    timings = {}
+    execute_salt_ssh(arg=[cmd], policy=policy, renderer=renderer,
+                     timings=timings)
+    execute_salt_sls('state.sls', ['ceph.minion'], policy=policy,
+                     renderer=renderer, timings=timings)
+    util.message(util.printable_bootstrap(timings, ['cmd.run', 'state.sls']))
+    return timings
 
 
 def main():
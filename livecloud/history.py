@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+'''
+Timing history of every state run, kept in a local SQLite database so
+slow-downs of the bring-up can be found from data.
+'''
+
+import os
+import time
+import json
+import sqlite3
+
+from livecloud import util
+from livecloud import summary
+
+
+HISTORY_DB = '/var/lib/livecloud/history.db'
+DAY = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    command TEXT NOT NULL,
+    arg TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS states (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    minion TEXT NOT NULL,
+    state_id TEXT NOT NULL,
+    function TEXT NOT NULL,
+    number INTEGER,
+    result INTEGER,
+    start TEXT,
+    duration REAL,
+    PRIMARY KEY (run_id, minion, state_id, function)
+);
+CREATE INDEX IF NOT EXISTS states_state ON states (function, state_id);
+CREATE INDEX IF NOT EXISTS runs_command ON runs (command, started);
+'''
+
+# None disables recording, set from deploy.py
+DATABASE = HISTORY_DB
+
+
+def set_database(path):
+    global DATABASE
+    DATABASE = path
+
+
+def connect(path=None):
+    path = path or DATABASE
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class Recorder(object):
+    '''
+    Store the states of each minion of one run as soon as it returns. The
+    run row is only created when the first minion is added.
+    '''
+
+    def __init__(self, conn, command, arg=()):
+        self.conn = conn
+        self.command = command
+        self.arg = json.dumps(list(arg))
+        self.run_id = None
+
+    def add(self, host):
+        if self.run_id is None:
+            cursor = self.conn.execute(
+                'INSERT INTO runs (started, command, arg) VALUES (?, ?, ?)',
+                (time.time(), self.command, self.arg))
+            self.run_id = cursor.lastrowid
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(self.run_id, host.minion, record.id, record.function,
+              record.number, int(bool(record.result)), record.start,
+              summary.duration_ms(record.duration))
+             for record in host.records])
+        self.conn.commit()
+
+
+def recorder(command, arg=()):
+    '''
+    Return a Recorder for a state run, None when the history is disabled
+    or its database cannot be opened: a deploy never fails because of it.
+    '''
+    if DATABASE is None:
+        return None
+    try:
+        return Recorder(connect(), command, arg)
+    except (OSError, sqlite3.Error), e:
+        util.message(util.colored_yellow(
+            '==> state history disabled, %s: %s' % (DATABASE, e)))
+        return None
+
+
+def slower_states(conn, days=7, ratio=1.2, limit=20, now=None):
+    '''
+    States whose average duration over the last ``days`` is ``ratio`` times
+    their average over the ``days`` before, the largest slow-down first.
+    '''
+    since = (now or time.time()) - days * DAY
+    before = since - days * DAY
+    rows = conn.execute('''
+        SELECT s.function, s.state_id,
+               AVG(CASE WHEN r.started < ? THEN s.duration END) AS baseline,
+               AVG(CASE WHEN r.started >= ? THEN s.duration END) AS recent,
+               COUNT(CASE WHEN r.started >= ? THEN s.duration END)
+        FROM states s JOIN runs r ON r.id = s.run_id
+        WHERE r.started >= ? AND s.duration IS NOT NULL
+        GROUP BY s.function, s.state_id
+        HAVING baseline > 0 AND recent >= baseline * ?
+        ORDER BY recent - baseline DESC
+        LIMIT ?''', (since, since, since, before, ratio, limit))
+    return [{'function': function, 'id': state_id, 'baseline': baseline,
+             'recent': recent, 'samples': samples,
+             'ratio': recent / baseline}
+            for function, state_id, baseline, recent, samples in rows]
+
+
+def critical_path(conn, command='state.highstate', top=5):
+    '''
+    States run one after the other on a minion, so the critical path of a
+    node is the sum of its state durations. Return, for the last run of
+    ``command``, each minion's total and its ``top`` slowest states, the
+    slowest minion first.
+    '''
+    row = conn.execute('SELECT id, started FROM runs WHERE command = ? '
+                       'ORDER BY started DESC LIMIT 1', (command,)).fetchone()
+    if row is None:
+        return []
+    run_id, started = row
+    paths = {}
+    for minion, function, state_id, duration in conn.execute('''
+            SELECT minion, function, state_id, duration FROM states
+            WHERE run_id = ? AND duration IS NOT NULL
+            ORDER BY minion, duration DESC''', (run_id,)):
+        path = paths.setdefault(minion, {
+            'minion': minion, 'run': run_id, 'started': started,
+            'total': 0.0, 'states': []})
+        path['total'] += duration
+        if len(path['states']) < top:
+            path['states'].append({'function': function, 'id': state_id,
+                                   'duration': duration})
+    return sorted(paths.values(), key=lambda path: path['total'],
+                  reverse=True)
+
+
+def query(name, days=7):
+    conn = connect()
+    try:
+        if name == 'slower':
+            return slower_states(conn, days)
+        return critical_path(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,173 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+'''
+Renderers write each minion's return to a stream as soon as it is given,
+in the colored text layout or as JSON / NDJSON for log systems.
+'''
+
+import sys
+import json
+
+from livecloud import util
+from livecloud import states
+from livecloud import summary
+
+
+OUTPUTS = ('text', 'json', 'ndjson')
+
+
+def record_to_dict(record):
+    return {
+        'id': record.id,
+        'function': record.function,
+        'name': record.name,
+        'number': record.number,
+        'result': record.result,
+        'comment': record.comment,
+        'changes': record.changes,
+        'start': record.start,
+        'duration': record.duration,
+    }
+
+
+def host_to_dict(minion, host, data):
+    if host is None:
+        return {'type': 'minion', 'minion': minion, 'return': data}
+    return {'type': 'minion', 'minion': minion,
+            'succeeded': host.succ, 'failed': host.fail,
+            'states': [record_to_dict(record) for record in host.records]}
+
+
+class TextRenderer(object):
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def _write_lines(self, lines):
+        # buffer at most one minion's output
+        self.stream.write('\n'.join(lines))
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def host(self, minion, host, data):
+        if host is None:
+            self._write_lines(util.iter_display({minion: data}))
+        else:
+            self._write_lines(util.iter_host(host))
+
+    def value(self, minion, data):
+        self._write_lines(util.iter_display({minion: data}))
+
+    def command(self, minion, data):
+        self._write_lines(util.iter_output_cmd({minion: data}))
+
+    def ssh(self, minion, data):
+        self._write_lines(util.iter_output_ssh({minion: data}))
+
+    def progress(self, minions, succ_num, fail_num):
+        self._write_lines([util.printable_progress(minions, succ_num,
+                                                   fail_num)])
+
+    def summary(self, cluster, title=None):
+        lines = [util.colored_yellow_bold(title)] if title else []
+        lines.append(util.printable_cluster(cluster))
+        self._write_lines(lines)
+
+    def history(self, name, rows, days=7):
+        if name == 'slower':
+            self._write_lines([util.printable_slower(rows, days)])
+        else:
+            self._write_lines([util.printable_critical_path(rows)])
+
+    def returns(self, data, cluster=None):
+        '''
+        Render every minion of a state return, collecting them in the
+        ClusterSummary which is returned.
+        '''
+        if cluster is None:
+            cluster = summary.ClusterSummary()
+        for minion, host, raw in states.iter_parse(data):
+            self.host(minion, host, raw)
+            if host is None:
+                cluster.add_failure(minion)
+            else:
+                cluster.add(host)
+        return cluster
+
+    def close(self):
+        '''
+        Called once by the owner of the renderer after the last return.
+        '''
+        self.stream.flush()
+
+
+class NdjsonRenderer(TextRenderer):
+    '''
+    One JSON document per line and per minion.
+    '''
+
+    def _write_doc(self, doc):
+        self.stream.write(json.dumps(doc, default=str))
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def host(self, minion, host, data):
+        self._write_doc(host_to_dict(minion, host, data))
+
+    def value(self, minion, data):
+        self._write_doc({'type': 'minion', 'minion': minion, 'return': data})
+
+    command = value
+    ssh = value
+
+    def progress(self, minions, succ_num, fail_num):
+        pass
+
+    def summary(self, cluster, title=None):
+        doc = cluster.to_dict()
+        if title:
+            doc['title'] = title
+        self._write_doc(doc)
+
+    def history(self, name, rows, days=7):
+        self._write_doc({'type': 'history', 'query': name, 'days': days,
+                         'rows': rows})
+
+
+class JsonRenderer(NdjsonRenderer):
+    '''
+    A single JSON array, written element by element.
+    '''
+
+    def __init__(self, stream=None):
+        super(JsonRenderer, self).__init__(stream)
+        self._count = 0
+
+    def _write_doc(self, doc):
+        self.stream.write(',\n' if self._count else '[\n')
+        self.stream.write(json.dumps(doc, default=str))
+        self._count += 1
+
+    def close(self):
+        self.stream.write('\n]\n' if self._count else '[]\n')
+        self.stream.flush()
+
+
+RENDERERS = {
+    'text': TextRenderer,
+    'json': JsonRenderer,
+    'ndjson': NdjsonRenderer,
+}
+
+
+def get_renderer(output='text', color=True, stream=None):
+    '''
+    Build the renderer of an output format. Machine-readable formats turn
+    colors off and move titles and progress messages to stderr.
+    '''
+    if output != 'text':
+        color = False
+        util.set_message_stream(sys.stderr)
+    util.set_color(color)
+    return RENDERERS[output](stream)
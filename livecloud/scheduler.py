@@ -0,0 +1,335 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from livecloud import util
+from livecloud import states
+from livecloud import clients
+from livecloud import render
+from livecloud import batch
+from livecloud import summary
+from livecloud import history
+from livecloud import deploy_ceph
+
+
+class Phase(object):
+    """
+    One step of the cluster bring-up, run as a salt job on each minion once
+    all phases it requires have succeeded on that same minion.
+
+    A phase with a ``runner`` is a barrier instead: after every wave it
+    runs once, as ``runner(renderer, minions)`` returning {minion: ok}, on
+    the minions given by ``targets()`` and only when all of them passed
+    the required phases.
+    """
+
+    def __init__(self, name, command, arg=(), requires=(), title=None,
+                 targets=None, runner=None):
+        self.name = name
+        self.command = command
+        self.arg = list(arg)
+        self.requires = tuple(requires)
+        self.title = title or name
+        self.targets = targets
+        self.runner = runner
+
+    @property
+    def is_barrier(self):
+        return self.runner is not None
+
+    @property
+    def is_state(self):
+        return self.command.startswith('state.')
+
+
+BRINGUP_PHASES = [
+    Phase('highstate', 'state.highstate', title='salt highstate'),
+    Phase('ntp', 'state.sls', ['ceph.ntp'], requires=['highstate'],
+          title='salt ntp state'),
+    Phase('ceph', 'state.sls', ['ceph.ceph'], requires=['highstate'],
+          title='salt ceph state'),
+    Phase('kvm', 'state.sls', ['ceph.kvm'], requires=['highstate'],
+          title='salt kvm state'),
+    # every monitor must start from the same monmap, built once
+    Phase('mon', 'ceph.mon_bootstrap', requires=['ceph', 'ntp'],
+          title='salt livecloud mon', targets=deploy_ceph.list_mons,
+          runner=deploy_ceph.bootstrap_mons),
+]
+
+
+# jobs run on a fixed set of threads, each creating its salt client once
+JOB_WORKERS = 8
+
+
+def check_phases(phases):
+    """
+    Raise ValueError on unknown or cyclic requirements.
+    """
+    by_name = dict((phase.name, phase) for phase in phases)
+    for phase in phases:
+        for name in phase.requires:
+            if name not in by_name:
+                raise ValueError('phase %s requires unknown phase %s' %
+                                 (phase.name, name))
+            if by_name[name].is_barrier and not phase.is_barrier:
+                raise ValueError('phase %s cannot require barrier phase %s'
+                                 % (phase.name, name))
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError('phase %s is part of a dependency cycle' % name)
+        visiting.add(name)
+        for required in by_name[name].requires:
+            visit(required)
+        visiting.discard(name)
+        visited.add(name)
+
+    for phase in phases:
+        visit(phase.name)
+    return by_name
+
+
+def phase_succeeded(phase, ret, retcode=0):
+    return batch.return_succeeded(phase.command, ret, retcode)
+
+
+class PhaseScheduler(object):
+    """
+    Run phases per minion following their declared dependencies. Every
+    minion starts its next phase as soon as its own prerequisites are
+    done, independently of the slower minions. Salt refuses a second state
+    run on a minion while one is running, so the state phases of a minion
+    run one after the other, in declared order. Minions becoming ready for
+    the same phase together share one job, and jobs run on ``workers``
+    threads which keep their salt client from one job to the next.
+    """
+
+    def __init__(self, phases=None, renderer=None, workers=JOB_WORKERS):
+        self.phases = list(phases or BRINGUP_PHASES)
+        self.renderer = renderer or render.TextRenderer()
+        self.by_name = check_phases(self.phases)
+        self.workers = workers
+        self._pool = None
+        self._results = Queue.Queue()
+        self._outstanding = 0
+        # phase name -> ClusterSummary of its state returns
+        self.summaries = dict(
+            (phase.name, summary.ClusterSummary(
+                recorder=history.recorder(phase.command, phase.arg)))
+            for phase in self.phases if phase.is_state)
+
+    def _run_job(self, phase, minions):
+        # every minion must get a result, run_wave waits for all of them
+        returned = set()
+        try:
+            # clients are per thread, each worker thread reuses its own
+            local = clients.local_client(phase.name)
+            for chunk in local.cmd_iter(tgt=minions, fun=phase.command,
+                                        arg=phase.arg, expr_form='list'):
+                for minion, data in chunk.items():
+                    returned.add(minion)
+                    ret = data.get('ret')
+                    ok = phase_succeeded(phase, ret, data.get('retcode', 0))
+                    self._results.put((minion, phase, ok, ret))
+        except Exception, e:
+            for minion in set(minions) - returned:
+                returned.add(minion)
+                self._results.put((minion, phase, False, repr(e)))
+        for minion in set(minions) - returned:
+            self._results.put((minion, phase, False, 'Minion did not return'))
+
+    def _dispatch(self, phase, minions):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        self._outstanding += len(minions)
+        self._pool.apply_async(self._run_job, (phase, minions))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _ready(self, minion, status):
+        state_running = any(self.by_name[name].is_state
+                            for name, state in status[minion].items()
+                            if state == 'running')
+        ready = []
+        for phase in self.phases:
+            if phase.is_barrier or phase.name in status[minion]:
+                continue
+            if not all(status[minion].get(name) == 'ok'
+                       for name in phase.requires):
+                continue
+            if phase.is_state:
+                if state_running:
+                    continue
+                state_running = True
+            ready.append(phase)
+        return ready
+
+    def _dispatch_ready(self, minions, status):
+        ready_minions = {}
+        for minion in minions:
+            for ready in self._ready(minion, status):
+                status[minion][ready.name] = 'running'
+                ready_minions.setdefault(ready.name, []).append(minion)
+        for phase in self.phases:
+            if phase.name in ready_minions:
+                self._dispatch(phase, ready_minions[phase.name])
+
+    def _skip(self, minion, status):
+        # mark everything depending on a failed phase as skipped
+        changed = True
+        while changed:
+            changed = False
+            for phase in self.phases:
+                # barrier phases are marked on their targets only
+                if phase.is_barrier or phase.name in status[minion]:
+                    continue
+                if any(status[minion].get(name) in ('failed', 'skipped')
+                       for name in phase.requires):
+                    status[minion][phase.name] = 'skipped'
+                    changed = True
+
+    def _render(self, minion, phase, ok, ret):
+        state = 'done' if ok else 'failed'
+        util.output_title('%s: %s %s' % (minion, phase.title, state))
+        if phase.is_state:
+            host = states.parse_host(minion, ret)
+            self.renderer.host(minion, host, ret)
+            if host is None:
+                self.summaries[phase.name].add_failure(minion)
+            else:
+                self.summaries[phase.name].add(host)
+        else:
+            self.renderer.value(minion, ret)
+
+    def _step(self, status):
+        # poll with a timeout so KeyboardInterrupt is delivered
+        try:
+            results = [self._results.get(timeout=1)]
+        except Queue.Empty:
+            return
+        # take every return already queued, so minions ready for the same
+        # phase are dispatched as one job
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Queue.Empty:
+                break
+        returned = []
+        for minion, phase, ok, ret in results:
+            self._outstanding -= 1
+            status[minion][phase.name] = 'ok' if ok else 'failed'
+            self._render(minion, phase, ok, ret)
+            if not ok:
+                self._skip(minion, status)
+            if minion not in returned:
+                returned.append(minion)
+        self._dispatch_ready(returned, status)
+
+    def run_wave(self, minions):
+        """
+        Run every phase on ``minions`` and return their status. Summaries,
+        history recorders and worker threads are kept for the next wave.
+        """
+        status = dict((minion, {}) for minion in minions)
+        self._dispatch_ready(minions, status)
+        while self._outstanding:
+            self._step(status)
+        return status
+
+    def run_barriers(self, status):
+        """
+        Run the barrier phases once every wave is done.
+        """
+        for phase in self.phases:
+            if not phase.is_barrier:
+                continue
+            targets = sorted(phase.targets() if phase.targets else status)
+            blocked = [minion for minion in targets
+                       if any(status.get(minion, {}).get(name) != 'ok'
+                              for name in phase.requires)]
+            for minion in targets:
+                status.setdefault(minion, {})
+            if not targets or blocked:
+                util.message(util.colored_red(
+                    '==> %s not run, %s did not pass %s' %
+                    (phase.title, ', '.join(blocked) or 'no target',
+                     ', '.join(phase.requires))))
+                for minion in targets:
+                    status[minion][phase.name] = 'skipped'
+                continue
+            util.output_title(phase.title)
+            for minion, ok in phase.runner(self.renderer, targets).items():
+                status.setdefault(minion, {})
+                status[minion][phase.name] = 'ok' if ok else 'failed'
+
+    def report(self, status):
+        for phase in self.phases:
+            cluster = self.summaries.get(phase.name)
+            if cluster is not None and cluster.minions:
+                self.renderer.summary(cluster, phase.title)
+        util.message(util.printable_phases(status,
+                                           [p.name for p in self.phases]))
+
+    def run(self, minions=None):
+        minions = minions or deploy_ceph.list_minions()
+        try:
+            status = self.run_wave(minions)
+        finally:
+            self.close()
+        self.run_barriers(status)
+        self.report(status)
+        return status
+
+
+def _failed_minions(status):
+    return [minion for minion, phases in status.items()
+            if any(state != 'ok' for state in phases.values())]
+
+
+def bringup(phases=None, policy=None, renderer=None):
+    """
+    Bring the cluster up, wave by wave when a batch policy is given. One
+    scheduler serves all waves, so each phase is recorded as one run in
+    the history and summarized once.
+    """
+    scheduler = PhaseScheduler(phases, renderer)
+    if policy is None:
+        return not _failed_minions(scheduler.run())
+
+    targets = deploy_ceph.list_minions()
+    waves = policy.waves(targets)
+    status = {}
+    try:
+        for index, wave in enumerate(waves):
+            util.log_screen('wave %d/%d: %d minions' %
+                            (index + 1, len(waves), len(wave)))
+            status.update(scheduler.run_wave(wave))
+            failed = len(_failed_minions(status))
+            if policy.exceeded(failed) and index + 1 < len(waves):
+                util.message(util.colored_red(
+                    '==> %d minions failed, stop before the remaining '
+                    'waves' % failed))
+                break
+    finally:
+        scheduler.close()
+    scheduler.run_barriers(status)
+    scheduler.report(status)
+    return not _failed_minions(status)
+
+
+def main():
+    bringup()
+
+
+if __name__ == '__main__':
+    main()
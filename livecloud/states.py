@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+'''
+Parse state returns of both LocalClient and salt-ssh into compact records.
+'''
+
+
+class StateRecord(object):
+    __slots__ = ('id', 'function', 'name', 'number', 'result', 'comment',
+                 'changes', 'start', 'duration')
+
+    def __init__(self, key, value):
+        func_left, self.id, rest = key.split('_|-', 2)
+        self.name, func_right = rest.rsplit('_|-', 1)
+        # a few hundred distinct functions repeated over every minion
+        self.function = intern('%s.%s' % (func_left, func_right))
+        self.number = value.get('__run_num__', 0)
+        self.result = value.get('result')
+        self.comment = (value.get('comment') or '').strip()
+        self.changes = value.get('changes') or ''
+        self.start = value.get('start_time', '')
+        self.duration = value.get('duration')
+
+
+class HostResult(object):
+    __slots__ = ('minion', 'records', 'succ', 'fail')
+
+    def __init__(self, minion, records):
+        self.minion = minion
+        self.records = records
+        self.succ = 0
+        self.fail = 0
+        for record in records:
+            if record.result:
+                self.succ += 1
+            else:
+                self.fail += 1
+
+
+def unwrap(data):
+    '''
+    Return the state dict of one minion, whatever client produced it:
+    LocalClient.cmd gives it as is, cmd_iter wraps it in 'ret' and
+    salt-ssh in 'return'.
+    '''
+    if isinstance(data, dict):
+        for wrapper in ('return', 'ret'):
+            if isinstance(data.get(wrapper), dict):
+                return data[wrapper]
+    return data
+
+
+def is_state_return(data):
+    return isinstance(data, dict) and bool(data) and all(
+        '_|-' in key for key in data)
+
+
+def parse_host(minion, data):
+    '''
+    Build the HostResult of one minion, None when it returned no states
+    (a render error list for instance).
+    '''
+    data = unwrap(data)
+    if not is_state_return(data):
+        return None
+    records = [StateRecord(key, value) for key, value in data.iteritems()]
+    records.sort(key=lambda record: record.number)
+    return HostResult(minion, records)
+
+
+def iter_parse(returns):
+    '''
+    Parse incrementally, ``returns`` being a full return dict or any
+    iterable of {minion: data} chunks such as LocalClient.cmd_iter.
+    Yields (minion, HostResult or None, raw data).
+    '''
+    if isinstance(returns, dict):
+        returns = [returns]
+    for chunk in returns:
+        for minion, data in chunk.iteritems():
+            yield minion, parse_host(minion, data), data
@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+#
+# @author: david_dong
+'''
+Aggregate the state returns of one run over every minion.
+'''
+
+import math
+
+
+def duration_ms(value):
+    '''
+    State durations are floats in ms, older salt releases give "12.3 ms".
+    '''
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        try:
+            return float(str(value).split()[0])
+        except (IndexError, ValueError):
+            return None
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of already sorted values.
+    '''
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class ClusterSummary(object):
+    '''
+    Totals of a run plus per-state duration statistics across hosts.
+    A host is an outlier when one of its states took ``outlier_factor``
+    times the cluster median of that state, ignoring states faster than
+    ``min_duration`` ms. Hosts are also handed to the history recorder.
+    '''
+
+    def __init__(self, outlier_factor=3.0, min_duration=1000.0,
+                 recorder=None):
+        self.recorder = recorder
+        self.outlier_factor = outlier_factor
+        self.min_duration = min_duration
+        self.minions = 0
+        self.succ = 0
+        self.fail = 0
+        self.failed_minions = []
+        # (state id, function) -> [(duration, minion)]
+        self.durations = {}
+        self.host_totals = {}
+
+    def add(self, host):
+        if self.recorder is not None:
+            self.recorder.add(host)
+        self.minions += 1
+        self.succ += host.succ
+        self.fail += host.fail
+        if host.fail:
+            self.failed_minions.append(host.minion)
+        total = 0.0
+        for record in host.records:
+            duration = duration_ms(record.duration)
+            if duration is None:
+                continue
+            total += duration
+            self.durations.setdefault((record.id, record.function),
+                                      []).append((duration, host.minion))
+        self.host_totals[host.minion] = total
+
+    def add_failure(self, minion):
+        '''
+        Count a minion which returned no state data.
+        '''
+        self.minions += 1
+        self.failed_minions.append(minion)
+
+    def state_stats(self):
+        '''
+        Return dicts of id, function, hosts, p50, p95, max and the slowest
+        minion for every state, slowest max first.
+        '''
+        stats = []
+        for (state_id, function), samples in self.durations.items():
+            samples.sort()
+            values = [duration for duration, _ in samples]
+            stats.append({
+                'id': state_id, 'function': function, 'hosts': len(values),
+                'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                'max': values[-1], 'slowest': samples[-1][1],
+            })
+        stats.sort(key=lambda stat: stat['max'], reverse=True)
+        return stats
+
+    def outlier_hosts(self):
+        '''
+        Return dicts of minion, total duration, number of outlier states and
+        the worst state with its ratio to the median, worst ratio first.
+        '''
+        hosts = {}
+        for (state_id, function), samples in self.durations.items():
+            values = sorted(duration for duration, _ in samples)
+            median = percentile(values, 50)
+            for duration, minion in samples:
+                if duration < self.min_duration:
+                    continue
+                ratio = duration / median if median else float('inf')
+                if ratio < self.outlier_factor:
+                    continue
+                host = hosts.setdefault(minion, {
+                    'minion': minion, 'total': self.host_totals[minion],
+                    'states': 0, 'ratio': 0.0})
+                host['states'] += 1
+                if ratio > host['ratio']:
+                    host.update({'ratio': ratio, 'worst': state_id,
+                                 'function': function, 'duration': duration,
+                                 'median': median})
+        return sorted(hosts.values(), key=lambda host: host['ratio'],
+                      reverse=True)
+
+    def to_dict(self, top=10):
+        return {'type': 'summary', 'minions': self.minions,
+                'succeeded': self.succ, 'failed': self.fail,
+                'failed_minions': sorted(self.failed_minions),
+                'slowest_states': self.state_stats()[:top],
+                'outlier_hosts': self.outlier_hosts()}
@@ -2,12 +2,87 @@
 #
 # @author: david_dong
 
+import os
+import sys
 import socket
-import netifaces
+import hashlib
+import tempfile
 
-from termcolor import colored
+import termcolor
 from numbers import Number
-from salt.ext.six import string_types
+
+string_types = basestring
+
+COLOR = True
+# titles and progress messages, kept off stdout for machine-readable output
+MESSAGES = None
+
+
+def set_color(enabled):
+    global COLOR
+    COLOR = enabled
+
+
+def set_message_stream(stream):
+    global MESSAGES
+    MESSAGES = stream
+
+
+def colored(text, color=None, on_color=None, attrs=None):
+    if not COLOR:
+        return text
+    return termcolor.colored(text, color, on_color, attrs)
+
+
+def message(text):
+    stream = MESSAGES or sys.stdout
+    stream.write('%s\n' % text)
+
+
+def file_digest(path):
+    '''
+    sha1 of a file, None when it does not exist.
+    '''
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def write_if_changed(path, content, mode=0644):
+    '''
+    Replace ``path`` with ``content`` only when it differs from the file on
+    disk, through a temporary file renamed over it so readers never see a
+    partial file. Return True when the file changed.
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if hashlib.sha1(content).hexdigest() == file_digest(path):
+        return False
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0777
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def log_written(path, changed):
+    log_screen('%s %s' % (path, 'changed' if changed else 'unchanged'))
 
 
 def resolve_ip():
@@ -21,6 +96,7 @@ def resolve_ip():
 
 
 def get_local_ipaddr(nic):
+    import netifaces
     ipaddr = '127.0.0.1'
     ipmask = '255.0.0.0'
     all_nics = netifaces.interfaces()
@@ -34,7 +110,7 @@ def get_local_ipaddr(nic):
 
 
 def log_screen(text):
-    print colored('==> %s' % text, 'cyan', attrs=['dark'])
+    message(colored('==> %s' % text, 'cyan', attrs=['dark']))
 
 
 def colored_cyan(text):
@@ -62,7 +138,7 @@ def colored_yellow_bold(text):
 
 
 def output_title(title):
-    print colored(title, 'yellow', attrs=['bold', 'dark'])
+    message(colored(title, 'yellow', attrs=['bold', 'dark']))
 
 
 def ustring(indent, raw_string, prefix='', suffix=''):
@@ -70,68 +146,65 @@ def ustring(indent, raw_string, prefix='', suffix=''):
     return '{0}{1}{2}{3}'.format(indent, prefix, raw_string, suffix)
 
 
-def display(data, indent, prefix, out):
+def iter_display(data, indent=0, prefix=''):
     if data is None or data is True or data is False:
-        out.append(colored_yellow_bold(ustring(indent, data, prefix)))
+        yield colored_yellow_bold(ustring(indent, data, prefix))
     elif isinstance(data, Number):
-        out.append(colored_yellow_bold(ustring(indent, data, prefix)))
+        yield colored_yellow_bold(ustring(indent, data, prefix))
     elif isinstance(data, string_types):
         for line in data.splitlines():
-            out.append(colored_green(ustring(indent, line, prefix)))
+            yield colored_green(ustring(indent, line, prefix))
     elif isinstance(data, (list, tuple)):
         for ind in data:
             if isinstance(ind, (list, tuple, dict)):
-                out.append(colored_green(ustring(indent, '|_')))
+                yield colored_green(ustring(indent, '|_'))
                 prefix = '' if isinstance(ind, dict) else '- '
-                display(ind, indent + 2, prefix, out)
+                for line in iter_display(ind, indent + 2, prefix):
+                    yield line
             else:
-                display(ind, indent, '- ', out)
+                for line in iter_display(ind, indent, '- '):
+                    yield line
     elif isinstance(data, dict):
         if indent:
-            out.append(colored_cyan(ustring(indent, '----------', prefix)))
+            yield colored_cyan(ustring(indent, '----------', prefix))
         for key in sorted(data):
             val = data[key]
-            out.append(colored_cyan(ustring(indent, key, suffix=':',
-                                            prefix=prefix)))
-            display(val, indent + 4, '', out)
-    return out
+            yield colored_cyan(ustring(indent, key, suffix=':',
+                                       prefix=prefix))
+            for line in iter_display(val, indent + 4, ''):
+                yield line
 
 
-def pretty_output_cmd(data):
-    output_list = list()
+def iter_output_cmd(data):
     for key in data:
-        output_list.append(colored_cyan(ustring(0, key, suffix=':')))
-        output_list.append(colored_green(ustring(4, data[key], suffix=':')))
-    print('\n'.join(output_list))
+        yield colored_cyan(ustring(0, key, suffix=':'))
+        yield colored_green(ustring(4, data[key], suffix=':'))
 
 
-def pretty_output_ssh(data):
-    output_list = list()
+def iter_output_ssh(data):
     for key in data:
-        output_list.append(colored_cyan(ustring(0, key, suffix=':')))
+        yield colored_cyan(ustring(0, key, suffix=':'))
         if len(data[key]) > 0:
-            output_list.append(colored_cyan(ustring(4, '-' * 10)))
-            output_list.append(colored_cyan(ustring(4, 'retcode:')))
+            yield colored_cyan(ustring(4, '-' * 10))
+            yield colored_cyan(ustring(4, 'retcode:'))
             if 'retcode' in data[key]:
                 output_text = ustring(8, data[key]['retcode'])
-                output_list.append(colored_yellow(output_text))
-            output_list.append(colored_cyan(ustring(4, 'return')))
+                yield colored_yellow(output_text)
+            yield colored_cyan(ustring(4, 'return'))
             if 'return' in data[key]:
                 output_text = ustring(8, data[key]['return'])
                 new_output = ('\n' + ' ' * 8).join(output_text.split('\n'))
-                output_list.append(colored_green(new_output))
-            output_list.append(colored_cyan(ustring(4, 'stderr')))
+                yield colored_green(new_output)
+            yield colored_cyan(ustring(4, 'stderr'))
             if 'stderr' in data[key]:
                 output_text = ustring(8, data[key]['stderr'])
                 new_output = ('\n' + ' ' * 8).join(output_text.split('\n'))
-                output_list.append(colored_red(new_output))
-            output_list.append(colored_cyan(ustring(4, 'stdout')))
+                yield colored_red(new_output)
+            yield colored_cyan(ustring(4, 'stdout'))
             if 'stdout' in data[key]:
                 output_text = ustring(8, data[key]['stdout'])
                 new_output = ('\n' + ' ' * 8).join(output_text.split('\n'))
-                output_list.append(colored_green(new_output))
-
-    print('\n'.join(output_list))
+                yield colored_green(new_output)
 
 
 def output_changes(changes):
@@ -178,42 +251,187 @@ def printable_summary(succ_num, fail_num):
     return '\n'.join(output_list)
 
 
-def pretty_output_sls(parse_from_dict, data):
-    final_data = parse_from_dict(data)
+def iter_host(host):
+    key = '%s:' % host.minion
+    if host.fail == 0:
+        yield colored_green(key)
+    else:
+        yield colored_red(key)
+
+    for record in host.records:
+        yield printable_obj(record, len(key))
+    yield printable_summary(host.succ, host.fail)
+
+
+def printable_progress(minions, succ_num, fail_num):
+    text = '==> {0} minions returned, {1} states succeeded, {2} failed'.format(
+        minions, succ_num, fail_num)
+    if fail_num > 0:
+        return colored_red(text)
+    return colored_cyan(text)
+
+
+def printable_phases(status, phase_names):
     output_list = list()
-    for key in final_data:
-        if final_data[key]['fail'] == 0:
-            output_list.append(colored_green(key))
+    output_list.append(colored_cyan('\nPhases'))
+    width = max([len(minion) for minion in status] + [6])
+    header = '{0:<{width}}  {1}'.format(
+        'Minion', '  '.join('{0:<9}'.format(name) for name in phase_names),
+        width=width).rstrip()
+    output_list.append(colored_cyan(header))
+    output_list.append(colored_cyan('-' * len(header)))
+    for minion in sorted(status):
+        cells = ['{0:<9}'.format(status[minion].get(name, '-'))
+                 for name in phase_names]
+        line = '{0:<{width}}  {1}'.format(minion, '  '.join(cells),
+                                          width=width).rstrip()
+        # a phase missing from the status did not apply to the minion
+        if all(state == 'ok' for state in status[minion].values()):
+            output_list.append(colored_green(line))
         else:
-            output_list.append(colored_red(key))
+            output_list.append(colored_red(line))
+    return '\n'.join(output_list)
+
+
+def printable_clients(rows):
+    output_list = list()
+    output_list.append(colored_cyan('\nSalt clients'))
+    saved_total = 0.0
+    for phase, kind, requests, created, saved in rows:
+        saved_total += saved
+        line = '{0:<24} {1:<6} used {2:>4}  created {3:>3}  saved {4:.2f}s'
+        output_list.append(colored_green(line.format(phase, kind, requests,
+                                                     created, saved)))
+    output_list.append(colored_cyan('Setup time saved:     {0:.2f}s'.format(
+        saved_total)))
+    return '\n'.join(output_list)
+
+
+def printable_cluster(cluster, top=10):
+    '''
+    Totals of a whole run followed by the slowest states and the hosts
+    which were far slower than the rest of the cluster.
+    '''
+    output_list = list()
+    output_list.append(printable_summary(cluster.succ, cluster.fail))
+    output_list.append(colored_cyan('Minions returned:     {}'.format(
+        cluster.minions)))
+    if cluster.failed_minions:
+        output_list.append(colored_red('Minions failed:       {}'.format(
+            ', '.join(sorted(cluster.failed_minions)))))
+
+    stats = cluster.state_stats()[:top]
+    if stats:
+        output_list.append(colored_cyan('\nSlowest states (ms)'))
+        width = max(len('%s %s' % (s['function'], s['id'])) for s in stats)
+        header = '{0:<{width}} {1:>5} {2:>9} {3:>9} {4:>9}  {5}'.format(
+            'State', 'hosts', 'p50', 'p95', 'max', 'slowest', width=width)
+        output_list.append(colored_cyan(header))
+        output_list.append(colored_cyan('-' * len(header)))
+        for s in stats:
+            line = ('{0:<{width}} {1:>5} {2:>9.1f} {3:>9.1f} {4:>9.1f}  '
+                    '{5}').format('%s %s' % (s['function'], s['id']),
+                                  s['hosts'], s['p50'], s['p95'], s['max'],
+                                  s['slowest'], width=width)
+            output_list.append(colored_green(line))
+
+    outliers = cluster.outlier_hosts()
+    if outliers:
+        output_list.append(colored_cyan(
+            '\nOutlier hosts (a state over {0:g}x its cluster median)'.format(
+                cluster.outlier_factor)))
+        for host in outliers:
+            line = ('{0}: {1} states, total {2:.1f} ms, worst {3} {4} '
+                    '{5:.1f} ms vs median {6:.1f} ms').format(
+                host['minion'], host['states'], host['total'],
+                host['function'], host['worst'], host['duration'],
+                host['median'])
+            output_list.append(colored_yellow(line))
+    return '\n'.join(output_list)
+
+
+def printable_slower(rows, days):
+    output_list = list()
+    output_list.append(colored_cyan(
+        '\nStates slower over the last {0} days (avg ms)'.format(days)))
+    if not rows:
+        output_list.append(colored_green('no state got slower'))
+    for row in rows:
+        line = '{0} {1}: {2:.1f} -> {3:.1f} ({4:.2f}x, {5} samples)'.format(
+            row['function'], row['id'], row['baseline'], row['recent'],
+            row['ratio'], row['samples'])
+        output_list.append(colored_yellow(line))
+    return '\n'.join(output_list)
+
+
+def printable_critical_path(paths):
+    output_list = list()
+    output_list.append(colored_cyan('\nCritical path of the last highstate'))
+    if not paths:
+        output_list.append(colored_yellow('no highstate recorded'))
+    for path in paths:
+        output_list.append(colored_green('{0}: {1:.1f} ms'.format(
+            path['minion'], path['total'])))
+        for state in path['states']:
+            share = state['duration'] * 100 / path['total'] \
+                if path['total'] else 0
+            output_list.append(colored_cyan(
+                '    {0} {1}: {2:.1f} ms ({3:.0f}%)'.format(
+                    state['function'], state['id'], state['duration'],
+                    share)))
+    return '\n'.join(output_list)
+
+
+def printable_bootstrap(timings, steps):
+    '''
+    Seconds from the start of each bootstrap job until a host returned, the
+    wait for a salt-ssh slot included, the hosts returning last first.
+    '''
+    output_list = list()
+    output_list.append(colored_cyan(
+        '\nBootstrap: seconds from job start to return (queue included)'))
+    width = max([len(host) for host in timings] + [4])
+    header = '{0:<{width}}  {1}'.format(
+        'Host', '  '.join('{0:>9}'.format(step) for step in steps),
+        width=width)
+    output_list.append(colored_cyan(header))
+    output_list.append(colored_cyan('-' * len(header)))
+    rows = sorted(timings.items(),
+                  key=lambda item: [item[1].get(step, 0.0)
+                                    for step in reversed(steps)],
+                  reverse=True)
+    for host, steps_timing in rows:
+        cells = ['{0:>9}'.format('%.1f' % steps_timing[step]
+                                 if step in steps_timing else '-')
+                 for step in steps]
+        line = '{0:<{width}}  {1}'.format(host, '  '.join(cells), width=width)
+        output_list.append(colored_green(line))
+    return '\n'.join(output_list)
+
 
-        value_list = final_data[key]['values']
-        values = sorted(value_list, key=lambda x: x['number'])
-        for obj in values:
-            output_list.append(printable_obj(obj, obj["result"]))
-        output_list.append(printable_summary(final_data[key]['succ'],
-                                             final_data[key]['fail']))
-    print('\n'.join(output_list))
+def printable_duration(duration):
+    return '' if duration is None else '%s ms' % duration
 
 
-def printable_obj(obj, result=True):
+def printable_obj(record, width):
     output_list = list()
-    output_list.append('-' * obj["len"])
-    output_list.append('{:>12}: {}'.format("ID", obj["id"]))
-    output_list.append('{:>12}: {}'.format("Function", obj["function"]))
-    output_list.append('{:>12}: {}'.format("Name", obj["name"]))
-    output_list.append('{:>12}: {}'.format("Result", obj["result"]))
-    new_comment = ('\n' + ' ' * 14).join(obj["comment"].split('\n'))
+    output_list.append('-' * width)
+    output_list.append('{:>12}: {}'.format("ID", record.id))
+    output_list.append('{:>12}: {}'.format("Function", record.function))
+    output_list.append('{:>12}: {}'.format("Name", record.name))
+    output_list.append('{:>12}: {}'.format("Result", record.result))
+    new_comment = ('\n' + ' ' * 14).join(record.comment.split('\n'))
     output_list.append('{:>12}: {}'.format("Comment", new_comment))
-    output_list.append('{:>12}: {}'.format("Started", obj["start"]))
-    output_list.append('{:>12}: {}'.format("Duration", obj["duration"]))
-    if obj["changes"]:
-        changes = output_changes(obj["changes"])
+    output_list.append('{:>12}: {}'.format("Started", record.start))
+    output_list.append('{:>12}: {}'.format(
+        "Duration", printable_duration(record.duration)))
+    if record.changes:
+        changes = output_changes(record.changes)
     else:
         changes = ''
     output_list.append('{:>12}: {}'.format("Changes", changes))
     buf = '\n'.join(output_list)
-    if result:
+    if record.result:
         return colored_green(buf)
     else:
         return colored_red(buf)
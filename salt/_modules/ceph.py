@@ -4,13 +4,24 @@
 # @author: david_dong
 
 import os
+import io
 import re
+import json
+import mmap
+import time
+import random
 import math
 import logging
 import shlex
+import base64
+import hashlib
+import shutil
 import subprocess
+import tempfile
 import platform
+import threading
 import jinja2
+from multiprocessing.pool import ThreadPool
 
 import salt.config
 import salt.loader
@@ -36,6 +47,7 @@ system = platform.system()
 if system == "Windows":
     __opts__ = salt.config.minion_config('/etc/salt/minion')
     __salt__ = salt.loader.minion_mods(__opts__)
+    __context__ = {}
 
 
 MON_PATH = '/var/lib/ceph/mon'
@@ -44,6 +56,7 @@ CEPH_CONF = '/etc/ceph/ceph.conf'
 PYAGEXEC_CONF = '/usr/local/livecloud/pyagexec/pyagexec.cfg'
 CEPH_CLUSTER = 'ceph'
 CEPH_MONMAP = '/var/lib/ceph/tmp/{cluster}_monmap'.format(cluster=CEPH_CLUSTER)
+DISK_BENCH_REPORT = '/var/lib/ceph/tmp/disk_bench.json'
 
 
 def _get_host():
@@ -212,11 +225,7 @@ ceph.conf
 """
 
 
-def _gen_ceph_conf(**context):
-    '''
-    params: fsid, public_network, cluster_network host_ips
-    '''
-    cephconf_template = '''[global]
+CEPHCONF_TEMPLATE = '''[global]
 fsid = {{ fsid }}
 pid file = /var/run/ceph/$name.pid
 log file = /var/log/ceph/$name.log
@@ -287,16 +296,90 @@ rbd cache max dirty age = 5
 host = {{ mon['host'] }}
 mon addr = {{ mon['ip'] }}:6789
 
+{% endfor -%}
+{% for section in host_sections -%}
+
+[{{ section['name'] }}]
+{% for option, value in section['options'] -%}
+{{ option }} = {{ value }}
+{% endfor %}
 {% endfor -%}
 '''
-    jinja_environment = jinja2.Environment()
-    template = jinja_environment.from_string(cephconf_template)
+
+_templates = {}
+
+
+def _get_template(source):
+    '''
+    Compile an inline template once per minion process.
+    '''
+    template = _templates.get(source)
+    if template is None:
+        template = _templates[source] = jinja2.Environment().from_string(
+            source)
+    return template
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def _write_if_changed(path, content, mode=0644):
+    '''
+    Atomically replace path when content differs from it, return True when
+    the file changed.
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if hashlib.sha1(content).hexdigest() == _file_digest(path):
+        return False
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0777
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    log.info('Write %s', path)
+    return True
+
+
+def _render_ceph_conf(**context):
+    '''
+    params: fsid, public_network, cluster_network host_ips, host_sections
+    host_sections defaults to the tuned [osd.N] sections of this host, so
+    every writer of ceph.conf keeps them.
+    '''
+    template = _get_template(CEPHCONF_TEMPLATE)
+    if 'host_sections' not in context:
+        context['host_sections'] = _host_sections()
     host_ips = context['host_ips']
     hosts = [host_ip['host'] for host_ip in host_ips]
     ips = [host_ip['ip'] for host_ip in host_ips]
     context.update({'hosts': hosts, 'ips': ips})
-    with open(CEPH_CONF, "wb") as f:
-        f.write(template.render(**context))
+    return template.render(**context)
+
+
+def _gen_ceph_conf(**context):
+    '''
+    params: fsid, public_network, cluster_network host_ips
+    Return True when ceph.conf changed.
+    '''
+    return _write_if_changed(CEPH_CONF, _render_ceph_conf(**context))
 
 
 """
@@ -304,23 +387,48 @@ create mon for each moniter
 """
 
 
-def _get_mon_hostslist():
-    MON_INT = __salt__['pillar.get']('ceph:mon:interface')
-    hosts = []
-    hostsitems = __salt__['mine.get']('roles:ceph-mon',
-                                      'grains.items',
-                                      'grain')
+def mon_addr():
+    '''
+    Mine function publishing only what the other minions need of a
+    monitor instead of its whole grains.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.mon_addr
+    '''
+    ips = __salt__['grains.get']('ip_interfaces:%s' % _get_mon_int()) or []
+    return {'host': _get_host(), 'mon_ip': ips[0] if ips else None}
+
+
+def _mon_addrs():
+    # {minion id: mon_addr} of the monitors having an address, read from
+    # the mine once per call
+    if 'ceph.mon_addrs' not in __context__:
+        addrs = __salt__['mine.get']('roles:ceph-mon', 'ceph.mon_addr',
+                                     'grain')
+        __context__['ceph.mon_addrs'] = dict(
+            (minion, addr) for minion, addr in addrs.items()
+            if addr and addr.get('mon_ip'))
+    return __context__['ceph.mon_addrs']
 
-    for _, grains in hostsitems.items():
-        data = {}
-        data.update({'host': grains['host']})
-        data.update({'ip': grains['ip_interfaces'][MON_INT][0]})
-        hosts.append(data)
 
-    return hosts
+def mon_hosts():
+    '''
+    Return [{host, ip}] of the monitors sorted by host, read from the mine
+    once per call.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.mon_hosts
+    '''
+    return sorted([{'host': addr['host'], 'ip': addr['mon_ip']}
+                   for addr in _mon_addrs().values()],
+                  key=lambda addr: addr['host'])
 
 
-def _gen_monmap(host_info_list, fsid=None):
+def _get_mon_hostslist():
+    return mon_hosts()
+
+
+def _gen_monmap(host_info_list, fsid=None, monmap=CEPH_MONMAP):
     fsid = fsid or _get_fsid()
     host_string = ''
     for host_info in host_info_list:
@@ -330,7 +438,7 @@ def _gen_monmap(host_info_list, fsid=None):
     fmt_line = 'monmaptool --cluster={cluster} --create --fsid={fsid} {monmap}'
     command_line = fmt_line.format(cluster=CEPH_CLUSTER,
                                    fsid=fsid,
-                                   monmap=CEPH_MONMAP)
+                                   monmap=monmap)
     final_line = command_line + host_string + ' --clobber '
     return command_check_output(final_line)
 
@@ -352,44 +460,28 @@ def _ceph_mon_start(host=None):
     return command(command_line)
 
 
-def create_mon(host_info_list, fsid=None):
-    '''
-    CLI Example:
-    .. code-block:: bash
-        salt '*' ceph.create_mon <host_list>
-    '''
-    fsid = fsid or _get_fsid()
-    ret = {'data': {}}
-    data = []
-
-    osd_num = __salt__['pillar.get']('ceph:global:total_osd')
-    total_pgs = math.pow(2, (math.ceil(math.log(
-                int(osd_num)*100/3)/math.log(2))))
-
-    # gen /etc/ceph/ceph.conf
-    _gen_ceph_conf(
+def _ceph_conf_context(host_info_list, fsid):
+    return dict(
         fsid=fsid,
         public_network=__salt__['pillar.get']('ceph:global:cluster_network'),
         cluster_network=__salt__['pillar.get']('ceph:global:public_network'),
-        total_pgs=int(total_pgs),
+        total_pgs=_default_pg_num(),
         host_ips=host_info_list
     )
 
-    # gen_mon_map
-    # Test monmap if exists
-    if not __salt__['file.file_exists'](CEPH_MONMAP):
-        data.append({'gen_monmap': _gen_monmap(host_info_list, fsid)})
 
+def _populate_mon(data):
+    host = _get_host()
     # populate_mon
-    mon_host = os.path.join(MON_PATH, 'mon.{host}'.format(host=_get_host()))
+    mon_host = os.path.join(MON_PATH, 'mon.{host}'.format(host=host))
     # Test mon_host if exists
     if not __salt__['file.directory_exists'](mon_host):
-        data.append({'gen_monmap': _ceph_mon_create(_get_host())})
+        data.append({'gen_monmap': _ceph_mon_create(host)})
 
     # start_mon
     ceph_host = os.path.join(
         MON_PATH,
-        '{cluster}-{host}'.format(cluster=CEPH_CLUSTER, host=_get_host())
+        '{cluster}-{host}'.format(cluster=CEPH_CLUSTER, host=host)
     )
     __salt__['file.mkdir'](ceph_host)
     __salt__['file.touch'](os.path.join(ceph_host, 'done'))
@@ -397,7 +489,29 @@ def create_mon(host_info_list, fsid=None):
 
     # start_mon
     if __salt__['file.file_exists'](os.path.join(ceph_host, 'done')):
-        data.append({'service': _ceph_mon_start(_get_host())})
+        data.append({'service': _ceph_mon_start(host)})
+
+
+def create_mon(host_info_list, fsid=None):
+    '''
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.create_mon <host_list>
+    '''
+    fsid = fsid or _get_fsid()
+    ret = {'data': {}}
+    data = []
+
+    # gen /etc/ceph/ceph.conf
+    changed = _gen_ceph_conf(**_ceph_conf_context(host_info_list, fsid))
+    data.append({'ceph_conf': 'changed' if changed else 'unchanged'})
+
+    # gen_mon_map
+    # Test monmap if exists
+    if not __salt__['file.file_exists'](CEPH_MONMAP):
+        data.append({'gen_monmap': _gen_monmap(host_info_list, fsid)})
+
+    _populate_mon(data)
 
     ret['data'] = data
     ret['comment'] = 'Create ceph mon node'
@@ -405,6 +519,64 @@ def create_mon(host_info_list, fsid=None):
     return ret
 
 
+def monmap(fsid=None):
+    '''
+    Build the monmap and the ceph.conf settings of the whole cluster once,
+    on a single monitor, for ceph.mon_bootstrap to install on every
+    monitor. The monmap is returned base64 encoded, ``conf`` is rendered
+    by each monitor with its own [osd.N] sections. ``mons`` holds the host
+    names in the monmap, ``minions`` the minion ids they were mined from.
+    CLI Example:
+    .. code-block:: bash
+        salt 'mon1' ceph.monmap
+    '''
+    fsid = fsid or _get_fsid()
+    host_info_list = _get_mon_hostslist()
+    tmp_dir = tempfile.mkdtemp(prefix='monmap.')
+    try:
+        path = os.path.join(tmp_dir, 'monmap')
+        _gen_monmap(host_info_list, fsid, path)
+        with open(path, 'rb') as f:
+            encoded = base64.b64encode(f.read())
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {
+        'fsid': fsid,
+        'mons': [host_info['host'] for host_info in host_info_list],
+        'minions': sorted(_mon_addrs()),
+        'monmap': encoded,
+        'conf': _ceph_conf_context(host_info_list, fsid),
+    }
+
+
+def mon_bootstrap(monmap, conf):
+    '''
+    Install the monmap and render ceph.conf from the settings built by
+    ceph.monmap, then mkfs and start the local monitor. Run on all
+    monitors in one job so they all start from the same map and form
+    quorum together.
+    CLI Example:
+    .. code-block:: bash
+        salt -G 'roles:ceph-mon' ceph.mon_bootstrap <monmap> <conf>
+    '''
+    ret = {'data': {}}
+    data = []
+    changed = _gen_ceph_conf(**conf)
+    data.append({'ceph_conf': 'changed' if changed else 'unchanged'})
+    monmap_dir = os.path.dirname(CEPH_MONMAP)
+    if not os.path.isdir(monmap_dir):
+        os.makedirs(monmap_dir)
+    changed = _write_if_changed(CEPH_MONMAP, base64.b64decode(monmap))
+    data.append({'monmap': 'changed' if changed else 'unchanged'})
+
+    _populate_mon(data)
+
+    ret['data'] = data
+    ret['comment'] = 'Bootstrap ceph mon node'
+    ret['result'] = True
+    return ret
+
+
 def mon():
     '''
     CLI Example:
@@ -431,14 +603,14 @@ create osd for each osd
 def _get_osd_hostslist():
     devices = []
     hostsitems = __salt__['mine.get']('roles:ceph-osd',
-                                      'grains.items',
+                                      'ceph.mon_addr',
                                       'grain')
 
-    for _, grains in hostsitems.items():
+    for _, addr in hostsitems.items():
         data = {}
-        data.update({'host': grains['host']})
+        data.update({'host': addr['host']})
         data.update({'ip': __salt__['pillar.get'](
-            'nodes:' + grains['host'] + ':devs')})
+            'nodes:' + addr['host'] + ':devs')})
         devices.append(data)
 
     return devices
@@ -455,22 +627,206 @@ def _osd_crush_map(osd_id, host=None):
     command_check_output(fmt_line.format(osd_id=osd_id, host=host))
 
 
+def _osd_crush_map_batch(osd_ids, host=None):
+    '''
+    Place several osds of one host: the host bucket is created and moved
+    under root=default once, then each osd is added by the monitor with
+    ``create-or-move``. Every step is applied atomically by the monitor, so
+    nodes running this at the same time do not overwrite each other as a
+    getcrushmap/setcrushmap round trip would.
+    '''
+    host = host or _get_host()
+    if not osd_ids:
+        return None
+
+    fmt_line = 'ceph osd crush add-bucket {host} host'
+    command_check_output(fmt_line.format(host=host))
+    fmt_line = 'ceph osd crush move {host} root=default'
+    command_check_output(fmt_line.format(host=host))
+    fmt_line = 'ceph osd crush create-or-move osd.{osd_id} 1.0 \
+                host={host} root=default'
+    for osd_id in osd_ids:
+        command_check_output(fmt_line.format(osd_id=osd_id, host=host))
+    return osd_ids
+
+
+"""
+disk inventory
+"""
+
+LSBLK_COLUMNS = ['NAME', 'TYPE', 'FSTYPE', 'UUID', 'PARTLABEL', 'PARTTYPE',
+                 'PTTYPE']
+
+
+class DiskInventory(object):
+    """
+    Snapshot of the block devices of this node, read by a single lsblk pass
+    and indexed by disk name:
+        {dev: {'pttype': ..., 'fstype': ..., 'uuid': ...,
+               'parts': {part: {'label': ..., 'type': ..., 'fstype': ...,
+                                'uuid': ...}}}}
+    Devices modified by partitioning or mkfs are invalidated and re-read on
+    their next lookup, the rest of the snapshot is kept.
+    """
+
+    def __init__(self):
+        self._disks = None
+        self._columns = list(LSBLK_COLUMNS)
+        self._lock = threading.Lock()
+
+    def _lsblk(self, dev=None):
+        fmt_line = 'lsblk -P -n -o {columns}'
+        if dev is not None:
+            fmt_line += ' /dev/{dev}'
+        arguments = _get_command_executable(fmt_line.format(
+            columns=','.join(self._columns), dev=dev))
+        log.info('Running command: %s' % ' '.join(arguments))
+        process = subprocess.Popen(arguments, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode != 0:
+            if 'PTTYPE' in self._columns and 'unknown column' in err:
+                # util-linux before 2.25 does not know PTTYPE
+                self._columns.remove('PTTYPE')
+                return self._lsblk(dev)
+            log.warning('lsblk failed: %s', err.strip())
+        return out or ''
+
+    def _parse(self, out):
+        disks = {}
+        disk = None
+        for line in out.splitlines():
+            row = dict(item.split('=', 1) for item in shlex.split(line))
+            if row.get('TYPE') == 'disk':
+                disk = {'pttype': row.get('PTTYPE') or None,
+                        'fstype': row.get('FSTYPE'),
+                        'uuid': row.get('UUID'),
+                        'parts': {}}
+                disks[row['NAME']] = disk
+            elif row.get('TYPE') == 'part' and disk is not None:
+                disk['parts'][row['NAME']] = {
+                    'label': row.get('PARTLABEL', ''),
+                    'type': row.get('PARTTYPE', ''),
+                    'fstype': row.get('FSTYPE', ''),
+                    'uuid': row.get('UUID', ''),
+                }
+        return disks
+
+    def _get(self, dev):
+        with self._lock:
+            if self._disks is None:
+                self._disks = self._parse(self._lsblk())
+            if dev not in self._disks:
+                command('udevadm settle')
+                self._disks.update(self._parse(self._lsblk(dev)))
+            return self._disks.get(dev, {'pttype': None, 'parts': {}})
+
+    def invalidate(self, dev):
+        with self._lock:
+            if self._disks is not None:
+                self._disks.pop(dev, None)
+
+    def partitions(self, dev):
+        return self._get(dev)['parts']
+
+    def pttype(self, dev):
+        disk = self._get(dev)
+        if disk['pttype']:
+            return disk['pttype']
+        # without PTTYPE, a GPT is recognised by its partition type GUIDs
+        for part in disk['parts'].values():
+            if '-' in part['type']:
+                return 'gpt'
+        return None
+
+    def has_partition(self, dev, value):
+        for part in self.partitions(dev).values():
+            if value in part['label']:
+                return True
+        return False
+
+
+class MountIndex(object):
+    """
+    Snapshot of blkid and /etc/fstab, indexed by device, by UUID and by
+    mount point so that device -> UUID -> osd id lookups cost a dict access.
+    Entries touched by mkfs or mount are refreshed individually.
+    """
+
+    def __init__(self):
+        self._uuids = None
+        self._mounts = None
+        self._devices = None
+        self._lock = threading.Lock()
+
+    def _load_blkid(self):
+        if self._uuids is None:
+            self._uuids = {}
+            for dev, info in __salt__['disk.blkid']().items():
+                self._uuids[dev] = info.get('UUID')
+
+    def _load_fstab(self):
+        if self._mounts is None:
+            self._mounts = {}
+            self._devices = {}
+            for mount_point, entry in __salt__['mount.fstab']().items():
+                self._mounts[mount_point] = entry['device']
+                self._devices[entry['device']] = mount_point
+
+    def uuid(self, dev):
+        with self._lock:
+            self._load_blkid()
+            if self._uuids.get(dev) is None:
+                info = __salt__['disk.blkid'](dev).get(dev, {})
+                self._uuids[dev] = info.get('UUID')
+            return self._uuids[dev]
+
+    def mount_point(self, device):
+        with self._lock:
+            self._load_fstab()
+            return self._devices.get(device)
+
+    def invalidate(self, dev):
+        with self._lock:
+            if self._uuids is not None:
+                self._uuids.pop(dev, None)
+
+    def set_mount(self, mount_point, device):
+        with self._lock:
+            self._load_fstab()
+            old_device = self._mounts.get(mount_point)
+            if old_device is not None:
+                self._devices.pop(old_device, None)
+            self._mounts[mount_point] = device
+            self._devices[device] = mount_point
+
+
+_inventory = DiskInventory()
+_mounts = MountIndex()
+
+
+def _reset_inventory():
+    global _inventory, _mounts
+    _inventory = DiskInventory()
+    _mounts = MountIndex()
+
+
 def _partiton_exist(**kwargs):
     '''
     @params: dev, value
     '''
-    fmt_line = 'sgdisk --print /dev/{dev} | grep {value}'
-    return cgrep(fmt_line.format(**kwargs))
+    return _inventory.has_partition(kwargs['dev'], kwargs['value'])
 
 
 def _make_gpt_label(**kwargs):
     '''
     @params: dev
     '''
-    fmt_line = 'parted -s /dev/{dev} print | grep gpt'
-    if not cgrep(fmt_line.format(**kwargs)):
+    if _inventory.pttype(kwargs['dev']) != 'gpt':
         fmt_line = 'parted -s /dev/{dev} mklabel gpt'
-        return command_check_output(fmt_line.format(**kwargs))
+        out = command_check_output(fmt_line.format(**kwargs))
+        _inventory.invalidate(kwargs['dev'])
+        return out
     else:
         return None
 
@@ -489,39 +845,425 @@ def _parted_dev(**kwargs):
             --typecode=1:{ptype_tobe} -- /dev/{dev}'
     kwargs.update({'osd_uuid': osd_uuid})
     _make_gpt_label(**kwargs)
-    return command_check_output(fmt_line.format(**kwargs))
+    out = command_check_output(fmt_line.format(**kwargs))
+    _inventory.invalidate(kwargs['dev'])
+    return out
+
+
+def _sgdisk_journal(journal_dev, sizes):
+    '''
+    Create every journal partition of a disk in one sgdisk call, sizes
+    being like '4G' or '6144M', partitions aligned on 1 MiB.
+    '''
+    final_string = 'sgdisk -a 2048 '
+    fmt_line = '-n {partnum}:0:+{size} -c "{partnum}:ceph journal" '
+    for i, size in enumerate(sizes):
+        final_string += fmt_line.format(partnum=i+1, size=size)
+    final_string += '-p /dev/{journal}'.format(journal=journal_dev)
+    out = command_check_output(final_string)
+    _inventory.invalidate(journal_dev)
+    return out
 
 
 def _parted_journal(**kwargs):
     '''
     @params: journal_dev, count, per_size
     '''
-    unit = kwargs['per_size'][-1]
-    size = int(kwargs['per_size'][:-1])
-    final_string = 'sgdisk '
+    return _sgdisk_journal(kwargs['journal_dev'],
+                           [kwargs['per_size']] * kwargs['count'])
+
+
+"""
+journal planner
+"""
+
+# MB/s assumed when neither pillar nor a disk benchmark gives one
+HDD_BANDWIDTH = 150
+SSD_BANDWIDTH = 450
+JOURNAL_ALIGN_MB = 1024
+
+
+def _partition_name(disk, number):
+    if re.match(r'(nvme|mmcblk)\d+', disk):
+        return '{disk}p{number}'.format(disk=disk, number=number)
+    return '{disk}{number}'.format(disk=disk, number=number)
+
+
+def _disk_size_mb(disk):
+    sectors = _read_sys('/sys/block/%s/size' % disk)
+    return int(sectors) * 512 // (1024 * 1024) if sectors else None
+
+
+def _bandwidth(dev, rotational=None):
+    '''
+    MB/s of a device: nodes:<host>:bandwidth:<dev> in pillar, else the
+    last ceph.bench_disks measure, else the default of its kind.
+    '''
+    declared = __salt__['pillar.get'](
+        'nodes:{host}:bandwidth:{dev}'.format(host=_get_host(), dev=dev))
+    if declared:
+        return float(declared)
+    measured = _load_disk_bench().get(dev, {}).get('seq_mb_s')
+    if measured:
+        return float(measured)
+    if rotational is None:
+        rotational = _is_rotational(dev)
+    return float(HDD_BANDWIDTH if rotational else SSD_BANDWIDTH)
+
+
+def _journal_disks(devs):
+    '''
+    Journal ssds of the node: the keys of nodes:<host>:journal, else the
+    ssd_list disks which are not data devs.
+    '''
+    journals = __salt__['pillar.get']('nodes:' + _get_host() + ':journal')
+    if journals:
+        return sorted(journals)
+    ssd_list = __salt__['pillar.get'](
+        'nodes:' + _get_host() + ':ssd_list') or []
+    return sorted(ssd for ssd in ssd_list if ssd not in devs)
+
+
+def _sync_interval(options=None):
+    '''
+    Seconds between filestore syncs: the max interval, unless the min one
+    is larger since ceph never syncs before min. Unset values are the
+    ceph.conf template ones.
+    '''
+    values = dict((option, value) for option, value, _ in
+                  options or _get_tuning())
+    return max(values.get('filestore min sync interval', 10),
+               values.get('filestore max sync interval', 15))
+
+
+def _journal_size_mb(bandwidth, sync_interval):
+    # ceph: osd journal size = 2 * throughput * filestore sync interval
+    size = 2 * bandwidth * sync_interval
+    return int(math.ceil(size / float(JOURNAL_ALIGN_MB))) * JOURNAL_ALIGN_MB
+
+
+def _plan_journals(devs, ssds, sync_interval):
+    '''
+    Give each data dev, fastest first, to the ssd whose bandwidth would be
+    the least loaded with it, so the osds per ssd follow its bandwidth.
+    '''
+    ssd_bw = dict((ssd, _bandwidth(ssd, False)) for ssd in ssds)
+    load = dict((ssd, 0.0) for ssd in ssds)
+    assigned = dict((ssd, []) for ssd in ssds)
+    dev_bw = dict((dev, _bandwidth(dev)) for dev in devs)
+    for dev in sorted(devs, key=lambda dev: (-dev_bw[dev], dev)):
+        ssd = min(ssds, key=lambda ssd: ((load[ssd] + dev_bw[dev]) /
+                                         ssd_bw[ssd], ssd))
+        load[ssd] += dev_bw[dev]
+        assigned[ssd].append(dev)
+
+    plan = {'ssds': {}, 'mapping': {}, 'warnings': []}
+    for ssd in ssds:
+        partitions = []
+        for number, dev in enumerate(sorted(assigned[ssd]), 1):
+            partition = _partition_name(ssd, number)
+            size = _journal_size_mb(dev_bw[dev], sync_interval)
+            partitions.append({'partition': partition, 'dev': dev,
+                               'size_mb': size})
+            plan['mapping'][dev] = partition
+        capacity = _disk_size_mb(ssd)
+        used = sum(part['size_mb'] for part in partitions)
+        if capacity is not None and used > capacity:
+            plan['warnings'].append('%s needs %d MB of journals, has %d MB' %
+                                    (ssd, used, capacity))
+        if load[ssd] > ssd_bw[ssd]:
+            plan['warnings'].append(
+                '%s gets %.0f MB/s of osd writes for %.0f MB/s' %
+                (ssd, load[ssd], ssd_bw[ssd]))
+        plan['ssds'][ssd] = {'bandwidth': ssd_bw[ssd], 'load': load[ssd],
+                             'partitions': partitions}
+    return plan
+
+
+def _get_journal_plan():
+    if 'ceph.journal_plan' not in __context__:
+        devs = list(__salt__['pillar.get'](
+            'nodes:' + _get_host() + ':devs') or [])
+        ssds = _journal_disks(devs)
+        sync_interval = _sync_interval()
+        flagged = _flagged_devs()
+        ssds = [ssd for ssd in ssds if ssd not in flagged]
+        if ssds:
+            plan = _plan_journals([dev for dev in devs if dev not in ssds
+                                   and dev not in flagged],
+                                  ssds, sync_interval)
+        else:
+            plan = {'ssds': {}, 'mapping': {}, 'warnings': []}
+        plan['sync_interval'] = sync_interval
+        for warning in plan['warnings']:
+            log.warning(warning)
+        __context__['ceph.journal_plan'] = plan
+    return __context__['ceph.journal_plan']
+
+
+def journal_plan():
+    '''
+    Plan the journals of this node: which ssd and partition each data dev
+    journals on, balanced by bandwidth (nodes:<host>:bandwidth:<dev> in
+    MB/s or defaults), partitions sized 2 x bandwidth x the effective
+    filestore sync interval rounded up to 1 GB. ``pillar`` is the equivalent
+    nodes:<host> mapping. ceph.journal and ceph.osd follow this plan for
+    devs without a journal in pillar.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.journal_plan
+    '''
+    plan = _get_journal_plan()
+    pillar = {'devs': {}, 'journal': {}}
+    for ssd, layout in plan['ssds'].items():
+        pillar['journal'][ssd] = {'partition': {
+            'sizes': ['%dM' % part['size_mb']
+                      for part in layout['partitions']]}}
+        for part in layout['partitions']:
+            pillar['devs'][part['dev']] = {'journal': part['partition']}
+    ret = {'data': dict(plan, pillar=pillar)}
+    ret['comment'] = 'Journal plan of {host}'.format(host=_get_host())
+    ret['result'] = True
+    return ret
+
+
+"""
+disk benchmark
+"""
+
+BENCH_SEQ_BLOCK = 1024 * 1024
+BENCH_RAND_BLOCK = 4096
+# a device is slow below this fraction of the median of its class
+BENCH_SLOW_RATIO = 0.5
+
+
+def _dev_path(dev):
+    # files and loop devices can be given by path for tests
+    return dev if dev.startswith('/') else '/dev/{dev}'.format(dev=dev)
+
+
+def _open_direct(path):
+    '''
+    Open read only, bypassing the page cache when the device or file
+    system allows it. Return (file, direct).
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+        direct = hasattr(os, 'O_DIRECT')
+    except OSError:
+        fd = os.open(path, os.O_RDONLY)
+        direct = False
+    return io.FileIO(fd, 'r', closefd=True), direct
 
-    fmt_line = '-n {partnum}:0:+{size}{unit} -c "{partnum}:ceph journal" '
-    for i in range(kwargs['count']):
-        final_string += fmt_line.format(partnum=i+1, unit=unit, size=size)
-    final_string += '-p /dev/{journal}'.format(journal=kwargs['journal_dev'])
-    return command_check_output(final_string)
+
+def _probe_disk(path, seq_mb, rand_reads, seconds):
+    '''
+    Sequential then random reads only, nothing is ever written. An empty
+    device or a read returning less than asked marks the disk failed.
+    '''
+    f, direct = _open_direct(path)
+    reasons = []
+    try:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        if not size:
+            return {'size_mb': 0, 'direct': direct, 'status': 'failed',
+                    'reasons': ['%s has a size of 0' % path]}
+        # O_DIRECT needs page aligned buffers, anonymous mmaps are
+        seq_buf = mmap.mmap(-1, BENCH_SEQ_BLOCK)
+        rand_buf = mmap.mmap(-1, BENCH_RAND_BLOCK)
+
+        read = 0
+        start = time.time()
+        while read < seq_mb * BENCH_SEQ_BLOCK and \
+                time.time() - start < seconds:
+            count = f.readinto(seq_buf)
+            if not count:
+                if read < size:
+                    reasons.append('sequential read stopped at %d of %d '
+                                   'bytes' % (read, size))
+                break
+            read += count
+        seq_time = max(time.time() - start, 1e-6)
+
+        blocks = max(size // BENCH_RAND_BLOCK, 1)
+        latencies = []
+        start = time.time()
+        while len(latencies) < rand_reads and time.time() - start < seconds:
+            began = time.time()
+            offset = random.randrange(blocks) * BENCH_RAND_BLOCK
+            f.seek(offset)
+            count = f.readinto(rand_buf)
+            latencies.append(time.time() - began)
+            if (count or 0) < min(BENCH_RAND_BLOCK, size - offset):
+                reasons.append('random read at %d returned %d bytes' %
+                               (offset, count or 0))
+                break
+        rand_time = max(time.time() - start, 1e-6)
+    finally:
+        f.close()
+    latencies.sort()
+    result = {
+        'size_mb': size // (1024 * 1024),
+        'direct': direct,
+        'seq_mb_s': round(read / seq_time / (1024 * 1024), 1),
+        'rand_iops': round(len(latencies) / rand_time, 1),
+        'latency_ms': round(sum(latencies) / len(latencies) * 1000, 3)
+        if latencies else None,
+        'latency_p99_ms': round(
+            latencies[int(len(latencies) * 0.99)] * 1000, 3)
+        if latencies else None,
+    }
+    if reasons:
+        result.update({'status': 'failed', 'reasons': reasons})
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def _classify_disks(report):
+    '''
+    Flag devices far slower than the median of their class (rotational or
+    not) on sequential bandwidth or random iops.
+    '''
+    for rotational in (True, False, None):
+        peers = [result for result in report.values()
+                 if result['status'] == 'ok' and
+                 result['rotational'] is rotational]
+        for key in ('seq_mb_s', 'rand_iops'):
+            median = _median([result[key] for result in peers])
+            if len(peers) < 2 or not median:
+                continue
+            for result in peers:
+                if result[key] < median * BENCH_SLOW_RATIO:
+                    result['status'] = 'slow'
+                    result.setdefault('reasons', []).append(
+                        '%s %.1f below half of the median %.1f' %
+                        (key, result[key], median))
+
+
+def _load_disk_bench():
+    if 'ceph.disk_bench' not in __context__:
+        try:
+            with open(DISK_BENCH_REPORT) as f:
+                __context__['ceph.disk_bench'] = json.load(f)['devices']
+        except (IOError, ValueError, KeyError):
+            __context__['ceph.disk_bench'] = {}
+    return __context__['ceph.disk_bench']
+
+
+def _flagged_devs():
+    return sorted(dev for dev, result in _load_disk_bench().items()
+                  if result.get('status') != 'ok')
+
+
+def bench_disks(devs=None, seq_mb=256, rand_reads=2000, seconds=5):
+    '''
+    Read-only benchmark of the candidate disks of this node (its devs,
+    journal disks and ssd_list, or ``devs`` given as names or paths, loop
+    devices and files included). Reports sequential MB/s, random 4k iops
+    and latency, and the rotational flag, marks disks far slower than
+    their peers as slow and unreadable ones as failed, and suggests
+    ssd_list and journals. The report is kept in
+    /var/lib/ceph/tmp/disk_bench.json: ceph.osd skips flagged disks and
+    the journal planner uses the measured bandwidths.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.bench_disks
+        salt '*' ceph.bench_disks devs=sdb,sdc seconds=2
+    '''
+    if devs is None:
+        node_devs = list(__salt__['pillar.get'](
+            'nodes:' + _get_host() + ':devs') or [])
+        devs = node_devs + [dev for dev in _journal_disks(node_devs) +
+                            (__salt__['pillar.get'](
+                                'nodes:' + _get_host() + ':ssd_list') or [])
+                            if dev not in node_devs]
+    elif isinstance(devs, basestring):
+        devs = devs.split(',')
+    devs = sorted(set(devs))
+
+    report = {}
+    for dev in devs:
+        path = _dev_path(dev)
+        is_block = not dev.startswith('/') or path.startswith('/dev/')
+        result = {'path': path, 'status': 'ok', 'rotational':
+                  _is_rotational(os.path.basename(path)) if is_block
+                  else None}
+        try:
+            result.update(_probe_disk(path, int(seq_mb), int(rand_reads),
+                                      float(seconds)))
+        except (IOError, OSError), e:
+            result.update({'status': 'failed', 'reasons': [str(e)]})
+        report[dev] = result
+    _classify_disks(report)
+
+    healthy = [dev for dev in devs if report[dev]['status'] == 'ok']
+    ssd_list = [dev for dev in healthy if report[dev]['rotational'] is False]
+    node_devs = __salt__['pillar.get']('nodes:' + _get_host() + ':devs') or []
+    data_devs = [dev for dev in healthy
+                 if dev in node_devs and dev not in ssd_list]
+    journal_ssds = [dev for dev in ssd_list if dev not in node_devs]
+
+    # keep the results of disks not benchmarked this time
+    merged = dict(_load_disk_bench())
+    merged.update(report)
+    __context__['ceph.disk_bench'] = merged
+    if not os.path.isdir(os.path.dirname(DISK_BENCH_REPORT)):
+        os.makedirs(os.path.dirname(DISK_BENCH_REPORT))
+    _write_if_changed(DISK_BENCH_REPORT, json.dumps(
+        {'time': time.time(), 'devices': merged}, indent=2,
+        sort_keys=True))
+
+    suggestion = {'ssd_list': ssd_list,
+                  'excluded': _flagged_devs()}
+    if journal_ssds and data_devs:
+        sync_interval = _sync_interval()
+        suggestion['journals'] = _plan_journals(
+            data_devs, journal_ssds, sync_interval)['mapping']
+    ret = {'data': {'devices': report, 'suggestion': suggestion}}
+    ret['comment'] = 'Disk benchmark of {host}'.format(host=_get_host())
+    ret['result'] = True
+    return ret
 
 
 def journal():
+    '''
+    Partition the journal ssds, as nodes:<host>:journal:<ssd>:partition
+    gives (count and per_size, or sizes) or else as ceph.journal_plan
+    computes.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.journal
+    '''
     ret = {'data': {}}
     data = []
-    journals = __salt__['pillar.get']('nodes:' + _get_host() + ':journal')
-    for journal in journals:
+    _reset_inventory()
+    plan = _get_journal_plan()
+    devs = list(__salt__['pillar.get']('nodes:' + _get_host() + ':devs') or
+                [])
+    for journal in _journal_disks(devs):
         part_regex = 'nodes:{host}:journal:{journal}:partition'
-        part_size = __salt__['pillar.get'](
-            part_regex.format(host=_get_host(),
-                              journal=journal)
-        )
-        if not _partiton_exist(dev=journal, value='journal'):
+        part_size = __salt__['pillar.get'](part_regex.format(
+            host=_get_host(), journal=journal)) or {}
+        if _partiton_exist(dev=journal, value='journal'):
+            continue
+        if 'count' in part_size:
             data.append({'parted': _parted_journal(
                 journal_dev=journal, count=part_size['count'],
                 per_size=part_size['per_size'])
             })
+        elif 'sizes' in part_size:
+            data.append({'parted': _sgdisk_journal(journal,
+                                                   part_size['sizes'])})
+        elif plan['ssds'].get(journal, {}).get('partitions'):
+            sizes = ['%dM' % part['size_mb']
+                     for part in plan['ssds'][journal]['partitions']]
+            data.append({'parted': _sgdisk_journal(journal, sizes)})
+    data.extend(plan['warnings'])
     ret['data'] = data
     ret['comment'] = 'Create journal partition'
     ret['result'] = True
@@ -533,13 +1275,14 @@ def _mkfs_dev(**kwargs):
     @params: dev
     '''
     fmt_line = 'mkfs -t xfs -f /dev/{dev}1'
-    return command_check_output(fmt_line.format(**kwargs))
+    out = command_check_output(fmt_line.format(**kwargs))
+    _inventory.invalidate(kwargs['dev'])
+    _mounts.invalidate('/dev/{dev}1'.format(**kwargs))
+    return out
 
 
 def _dev_to_uuid(dev):
-    blkid_info = __salt__['disk.blkid']()
-    device_uuid = blkid_info.get(dev, {}).get('UUID')
-    return 'UUID=%s' % (device_uuid)
+    return 'UUID=%s' % (_mounts.uuid(dev))
 
 
 def _mount_dev(**kwargs):
@@ -550,8 +1293,10 @@ def _mount_dev(**kwargs):
         __salt__['file.mkdir'](kwargs['osd_mount_point'])
     __salt__['mount.mount'](kwargs['osd_mount_point'], kwargs['osd_dev_uuid'],
                             fstype='xfs')
-    return __salt__['mount.set_fstab'](kwargs['osd_mount_point'],
-                                       kwargs['osd_dev_uuid'], 'xfs')
+    ret = __salt__['mount.set_fstab'](kwargs['osd_mount_point'],
+                                      kwargs['osd_dev_uuid'], 'xfs')
+    _mounts.set_mount(kwargs['osd_mount_point'], kwargs['osd_dev_uuid'])
+    return ret
 
 
 def _replace_journal(**kwargs):
@@ -604,54 +1349,38 @@ def _ceph_autostart():
 
 
 def _is_mount(dev_uuid):
-    fstablists = __salt__['mount.fstab']()
-    ret = False
-    for _, entry in fstablists.items():
-        if entry['device'] == dev_uuid:
-            ret = True
-            break
-    return ret
+    return _mounts.mount_point(dev_uuid) is not None
 
 
 def _get_id_from_dev(osd_dev_uuid):
-    fstablists = __salt__['mount.fstab']()
-    osd_mount_point = ''
-    for key, entry in fstablists.items():
-        if entry['device'] == osd_dev_uuid:
-            osd_mount_point = key
-            break
-
+    osd_mount_point = _mounts.mount_point(osd_dev_uuid) or ''
     ret = re.findall(r'(\d+)', osd_mount_point)
     return int(ret[0]) if ret else -1
 
 
-def create_osd(dev, journal_dev=None):
+def _get_osd_mount_point(osd_id):
+    return os.path.join(OSD_PATH, 'ceph-{osd_id}'.format(osd_id=osd_id))
+
+
+def _osd_prepare(dev):
     '''
-    CLI Example:
-    .. code-block:: bash
-        salt '*' ceph.create_osd <dev> <journal_dev>
+    Partition and format the data disk, safe to run concurrently per device.
     '''
-    def __get_osd_mount_point(osd_id):
-        return os.path.join(OSD_PATH, 'ceph-{osd_id}'.format(osd_id=osd_id))
-
-    ret = {'data': {}}
     data = []
-    # prepare_disk
-
     if not _partiton_exist(dev=dev, value='ceph'):
         data.append({'parted': _parted_dev(dev=dev)})
         data.append({'parted': _mkfs_dev(dev=dev)})
     else:
         data.append({'parted': 'exist'})
+    return data
 
-    # format_disk
-    # fmt_line = 'parted -s /dev/{dev} print | grep xfs'
-    # if not cgrep(fmt_line.format(dev=dev)):
-    #    data.append({'parted': _mkfs_dev(dev=dev)})
-    # else:
-    #    data.append({'parted': 'exist'})
 
-    # mount_osd
+def _osd_allocate(dev):
+    '''
+    Allocate an osd id and mount the data partition, changes cluster state
+    and /etc/fstab so it must be serialized.
+    '''
+    data = []
     osd_dev = '/dev/{dev}1'.format(dev=dev)
     osd_dev_uuid = _dev_to_uuid(osd_dev)
     if not _is_mount(osd_dev_uuid):
@@ -660,15 +1389,21 @@ def create_osd(dev, journal_dev=None):
         data.append({'osd_id': osd_id})
         data.append({'mounted': _mount_dev(
             osd_dev_uuid=osd_dev_uuid,
-            osd_mount_point=__get_osd_mount_point(osd_id))
+            osd_mount_point=_get_osd_mount_point(osd_id))
         })
     else:
         osd_id = _get_id_from_dev(osd_dev_uuid)
         data.append({'osd_id': osd_id})
         data.append({'mounted': 'already'})
+    return osd_id, data
 
-    # create_osd
-    osd_mount_point = __get_osd_mount_point(osd_id)
+
+def _osd_mkfs(osd_id, journal_dev=None):
+    '''
+    Populate the osd data dir and journal, safe to run concurrently per osd.
+    '''
+    data = []
+    osd_mount_point = _get_osd_mount_point(osd_id)
     ready_path = os.path.join(osd_mount_point, 'ready')
     if not __salt__['file.file_exists'](ready_path):
         data.append({'create': _ceph_osd_create(osd_id, osd_mount_point)})
@@ -682,74 +1417,268 @@ def create_osd(dev, journal_dev=None):
                          osd_id=osd_id,
                          journal_dev=journal_dev,
                          journal_path=journal_path)
+    return data
+
 
-    if __salt__['file.file_exists'](journal_path):
+def _osd_activate(osd_id, crush=True):
+    '''
+    Place the osd in the crush map and start it, must be serialized.
+    '''
+    data = []
+    osd_mount_point = _get_osd_mount_point(osd_id)
+    journal_path = os.path.join(osd_mount_point, 'journal')
+    if crush and __salt__['file.file_exists'](journal_path):
         # ceph_osd_crush
         _osd_crush_map(osd_id, _get_host())
 
     # _update_ini(osd_id, _get_host())
+    changed = _apply_tuning()
+    data.append({'tuning': 'changed' if changed else 'unchanged'})
     __salt__['file.touch'](os.path.join(osd_mount_point, 'sysvinit'))
 
     data.append({'service': _ceph_osd_start(osd_id)})
     data.append({'autostart': _ceph_autostart()})
+    return data
+
+
+def _osd_result(osd_id, data):
+    ret = {'data': {}}
     ret['data']['osd.{osd_id}'.format(osd_id=osd_id)] = data
     ret['comment'] = 'Create ceph osd node'
     ret['result'] = True
     return ret
 
 
-def osd():
+def _create_osd(dev, journal_dev=None):
+    # prepare_disk
+    data = _osd_prepare(dev)
+    # mount_osd
+    osd_id, allocated = _osd_allocate(dev)
+    data.extend(allocated)
+    # create_osd
+    data.extend(_osd_mkfs(osd_id, journal_dev))
+    data.extend(_osd_activate(osd_id))
+    return _osd_result(osd_id, data)
+
+
+def create_osd(dev, journal_dev=None):
+    '''
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.create_osd <dev> <journal_dev>
+    '''
+    # never make osds of disks ceph.bench_disks found slow or failing
+    flagged = [disk for disk in (dev, journal_dev)
+               if disk and _parent_disk(disk) in _flagged_devs()]
+    if flagged:
+        return {'data': {'flagged': flagged},
+                'comment': 'Refuse disks flagged by ceph.bench_disks: %s' %
+                           ', '.join(flagged),
+                'result': False}
+    _reset_inventory()
+    return _create_osd(dev, journal_dev)
+
+
+def _get_osd_workers(workers=None):
+    if workers is None:
+        workers = __salt__['pillar.get']('ceph:osd:workers', 1)
+    return max(int(workers), 1)
+
+
+def osd(workers=None):
     '''
+    Create an osd for every dev of this node. With workers > 1 the disks
+    are partitioned, formatted and mkfs-ed by a bounded thread pool, while
+    ``ceph osd create`` and mounting stay serialized. The host bucket is
+    placed once, then each new osd by ``ceph osd crush create-or-move``.
+    Defaults to pillar ``ceph:osd:workers`` or 1.
+
     CLI Example:
     .. code-block:: bash
         salt '*' ceph.osd
+        salt '*' ceph.osd workers=8
     '''
-    ret = []
     devs = __salt__['pillar.get']('nodes:' + _get_host() + ':devs')
+    plan = _get_journal_plan()
+    # never make osds of disks ceph.bench_disks found slow or failing
+    flagged = _flagged_devs()
+    if flagged:
+        log.warning('Skip flagged disks %s', ', '.join(flagged))
+    devs = [dev for dev in devs
+            if dev not in plan['ssds'] and dev not in flagged]
+    journals = []
     for dev in devs:
         fmt_line = 'nodes:{host}:devs:{dev}:journal'
-        journal = __salt__['pillar.get'](
-            fmt_line.format(host=_get_host(), dev=dev))
-        ret.append(create_osd(dev, journal))
+        journals.append(__salt__['pillar.get'](
+            fmt_line.format(host=_get_host(), dev=dev)) or
+            plan['mapping'].get(dev))
+
+    _reset_inventory()
+    workers = min(_get_osd_workers(workers), len(devs))
+    pool = ThreadPool(workers) if workers > 1 else None
+    parallel_map = pool.map if pool else map
+    try:
+        # prepare_disk
+        prepared = parallel_map(_osd_prepare, devs)
+        # mount_osd
+        allocated = [_osd_allocate(dev) for dev in devs]
+        osd_ids = [osd_id for osd_id, _ in allocated]
+        # create_osd
+        created = parallel_map(lambda args: _osd_mkfs(*args),
+                               zip(osd_ids, journals))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # ceph_osd_crush
+    crush_ids = [osd_id for osd_id in osd_ids if __salt__['file.file_exists'](
+        os.path.join(_get_osd_mount_point(osd_id), 'journal'))]
+    _osd_crush_map_batch(crush_ids, _get_host())
+
+    ret = []
+    for index, osd_id in enumerate(osd_ids):
+        data = prepared[index] + allocated[index][1] + created[index]
+        data.extend(_osd_activate(osd_id, crush=False))
+        ret.append(_osd_result(osd_id, data))
     return ret
 
 
+UDEV_RULES = '/etc/udev/rules.d/99-ssd.rules'
+
+# queue attributes per device class, schedulers by order of preference
+# as blk-mq kernels name them differently
+QUEUE_SETTINGS = {
+    'hdd': [('rotational', '1'),
+            ('scheduler', ('deadline', 'mq-deadline')),
+            ('read_ahead_kb', '4096'),
+            ('nr_requests', '512'),
+            ('max_sectors_kb', '1024')],
+    'ssd': [('rotational', '0'),
+            ('scheduler', ('noop', 'none')),
+            ('read_ahead_kb', '128'),
+            ('nr_requests', '256'),
+            ('max_sectors_kb', '512')],
+}
+
+
+def _udev_rule(disk, settings):
+    attrs = ', '.join('ATTR{queue/%s}="%s"' % (attr, value)
+                      for attr, value in settings)
+    return 'SUBSYSTEM=="block", ACTION=="add|change", KERNEL=="{disk}", ' \
+        '{attrs}\n'.format(disk=disk, attrs=attrs)
+
+
 def generate_udev_rules(disk, attr1, attr2):
-    rules_fmt = '{subsystem}, {action}, {kernel}, {attr1}, {attr2}\n'
-    return rules_fmt.format(
-                subsystem='SUBSYSTEM=="block"',
-                action='ACTION=="add|change"',
-                kernel='KERNEL=="' + disk + '"',
-                attr1='ATTR{queue/rotational}="' + str(attr1) + '"',
-                attr2='ATTR{queue/scheduler}="' + attr2 + '"',)
+    return _udev_rule(disk, [('rotational', attr1), ('scheduler', attr2)])
+
+
+def _read_queue(disk, attr):
+    value = _read_sys('/sys/block/{disk}/queue/{attr}'.format(
+        disk=disk, attr=attr))
+    if value and attr == 'scheduler':
+        # "noop [deadline] cfq": the selected one is in brackets
+        selected = re.search(r'\[(\S+)\]', value)
+        return selected.group(1) if selected else value
+    return value
+
+
+def _queue_settings(disk, disk_class):
+    '''
+    Settings of a disk for its class, fitted to what it supports.
+    '''
+    settings = []
+    for attr, value in QUEUE_SETTINGS[disk_class]:
+        if attr == 'scheduler':
+            available = (_read_sys('/sys/block/{disk}/queue/scheduler'.format(
+                disk=disk)) or '').replace('[', '').replace(']', '').split()
+            value = next((name for name in value if name in available),
+                         value[0])
+        elif attr == 'max_sectors_kb':
+            hw_max = _read_sys('/sys/block/{disk}/queue/max_hw_sectors_kb'
+                               .format(disk=disk))
+            if hw_max:
+                value = str(min(int(value), int(hw_max)))
+        settings.append((attr, value))
+    return settings
+
+
+def _disk_class(disk, ssd_list):
+    if disk in ssd_list:
+        return 'ssd'
+    measured = _load_disk_bench().get(disk, {}).get('rotational')
+    if measured is False:
+        return 'ssd'
+    return 'hdd'
 
 
 def udev_rules():
     '''
+    Manage one udev rule per disk of the node setting rotational,
+    scheduler, read_ahead_kb, nr_requests and max_sectors_kb by class
+    (ssd_list or measured non-rotational disks are ssd, others hdd). The
+    rules file is only rewritten when it changes, only disks whose rule
+    or queue values differ are triggered, and the sysfs values are
+    checked afterwards.
     CLI Example:
     .. code-block:: bash
         salt '*' ceph.udev_rules
     '''
-    ret = []
-    ssd_list = __salt__['pillar.get']('nodes:' + _get_host() + ':ssd_list')
-    hdd_list = list()
-    devs = __salt__['pillar.get']('nodes:' + _get_host() + ':devs')
-    for dev in devs:
-        if dev not in ssd_list:
-            hdd_list.append(dev)
-
-    rules = ""
-    for hdd in hdd_list:
-        rules += generate_udev_rules(hdd, 1, 'deadline')
-    for ssd in ssd_list:
-        rules += generate_udev_rules(ssd, 0, 'noop')
-
-    __salt__['file.touch']('/etc/udev/rules.d/99-ssd.rules')
-    __salt__['file.append']('/etc/udev/rules.d/99-ssd.rules', rules)
-    ret['comment'] = 'udevadm control --reload-rules'
-    command_check_output('udevadm control --reload-rules')
-    command_check_output('udevadm trigger')
-    ret['result'] = True
+    ret = {'data': {}}
+    ssd_list = __salt__['pillar.get'](
+        'nodes:' + _get_host() + ':ssd_list') or []
+    devs = list(__salt__['pillar.get']('nodes:' + _get_host() + ':devs') or
+                [])
+    disks = sorted(set(devs + list(ssd_list) + _journal_disks(devs)))
+
+    old_rules = {}
+    if os.path.exists(UDEV_RULES):
+        with open(UDEV_RULES) as f:
+            for line in f:
+                disk = re.search(r'KERNEL=="([^"]+)"', line)
+                if disk:
+                    old_rules[disk.group(1)] = line
+
+    rules = ['# managed by salt ceph.udev_rules, local changes are lost\n']
+    classes = {}
+    wanted = {}
+    trigger = []
+    for disk in disks:
+        classes[disk] = _disk_class(disk, ssd_list)
+        settings = _queue_settings(disk, classes[disk])
+        wanted[disk] = settings
+        rule = _udev_rule(disk, settings)
+        rules.append(rule)
+        if old_rules.get(disk) != rule or any(
+                _read_queue(disk, attr) != value for attr, value in settings):
+            trigger.append(disk)
+
+    changed = _write_if_changed(UDEV_RULES, ''.join(rules))
+    if changed:
+        command_check_output('udevadm control --reload-rules')
+    if trigger:
+        command_check_output(
+            'udevadm trigger --action=change --subsystem-match=block ' +
+            ' '.join('--sysname-match=%s' % disk for disk in trigger))
+        command_check_output('udevadm settle')
+
+    verified = True
+    for disk in disks:
+        mismatch = {}
+        for attr, value in wanted[disk]:
+            current = _read_queue(disk, attr)
+            if current != value:
+                mismatch[attr] = {'want': value, 'got': current}
+        verified = verified and not mismatch
+        ret['data'][disk] = {
+            'class': classes[disk],
+            'settings': dict(wanted[disk]),
+            'triggered': disk in trigger,
+            'mismatch': mismatch,
+        }
+    ret['comment'] = 'rules %s, %d disks triggered' % (
+        'changed' if changed else 'unchanged', len(trigger))
+    ret['result'] = verified
     return ret
 
 
@@ -760,12 +1689,412 @@ def uuid():
         salt '*' ceph.uuid
     '''
     ret = []
+    _reset_inventory()
     ret.append(_dev_to_uuid('/dev/sdb1'))
     return ret
 
 
+"""
+tuning profiles
+"""
+
+TUNING_PROFILES = {
+    # many spinning disks per host, journals on the same disks
+    'hdd-dense': {
+        'osd op threads': 4,
+        'osd disk threads': 1,
+        'filestore op threads': 8,
+        'filestore min sync interval': 10,
+        'filestore max sync interval': 15,
+        'filestore queue max ops': 5000,
+        'journal max write entries': 1000,
+        'osd recovery max active': 3,
+        'osd max backfills': 1,
+    },
+    # spinning data disks with journals on ssd
+    'hybrid': {
+        'osd op threads': 8,
+        'osd disk threads': 2,
+        'filestore op threads': 16,
+        'filestore min sync interval': 5,
+        'filestore max sync interval': 10,
+        'filestore queue max ops': 25000,
+        'journal max write entries': 10000,
+        'osd recovery max active': 5,
+        'osd max backfills': 2,
+    },
+    'ssd': {
+        'osd op threads': 8,
+        'osd disk threads': 4,
+        'filestore op threads': 32,
+        'filestore min sync interval': 2,
+        'filestore max sync interval': 5,
+        'filestore queue max ops': 50000,
+        'journal max write entries': 10000,
+        'osd recovery max active': 10,
+        'osd max backfills': 4,
+    },
+}
+
+
+def _read_sys(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return default
+
+
+def _parent_disk(dev):
+    # whole disks ending in a digit (loop0, md127) are not partitions
+    if os.path.exists('/sys/block/%s' % dev):
+        return dev
+    if re.match(r'(nvme|mmcblk)\d+', dev):
+        return re.sub(r'p\d+$', '', dev)
+    return re.sub(r'(?<=[a-z])\d+$', '', dev)
+
+
+def _is_rotational(dev):
+    disk = _parent_disk(dev)
+    return _read_sys('/sys/block/%s/queue/rotational' % disk, '1') == '1'
+
+
+def _disk_rotational(dev, ssd_list):
+    '''
+    Whether a disk spins: ssd_list first, then the rotational flag of the
+    last ceph.bench_disks, then sysfs.
+    '''
+    if dev in ssd_list or _parent_disk(dev) in ssd_list:
+        return False
+    measured = _load_disk_bench().get(dev, {}).get('rotational')
+    if measured is not None:
+        return measured
+    return _is_rotational(dev)
+
+
+def _node_devs():
+    devs = __salt__['pillar.get']('nodes:' + _get_host() + ':devs') or []
+    # the same journal ssds ceph.journal_plan maps the devs onto
+    journal_devs = set(_journal_disks(devs))
+    if isinstance(devs, dict):
+        for conf in devs.values():
+            if isinstance(conf, dict) and conf.get('journal'):
+                journal_devs.add(_parent_disk(conf['journal']))
+    return list(devs), sorted(journal_devs)
+
+
+def _host_hardware():
+    devs, journal_devs = _node_devs()
+    ssd_list = __salt__['pillar.get'](
+        'nodes:' + _get_host() + ':ssd_list') or []
+    speed = _read_sys('/sys/class/net/%s/speed' % _get_mon_int())
+    try:
+        speed = int(speed) if speed and int(speed) > 0 else None
+    except ValueError:
+        speed = None
+    return {
+        'num_cpus': int(__salt__['grains.get']('num_cpus', 1) or 1),
+        'mem_total': int(__salt__['grains.get']('mem_total', 0) or 0),
+        'devs': dict((dev, _disk_rotational(dev, ssd_list))
+                     for dev in devs),
+        'journal_devs': dict((dev, _disk_rotational(dev, ssd_list))
+                             for dev in journal_devs),
+        'nic_speed': speed,
+    }
+
+
+def _select_profile(hw, profile=None):
+    profile = (profile or
+               __salt__['pillar.get']('nodes:' + _get_host() +
+                                      ':tuning_profile') or
+               __salt__['pillar.get']('ceph:tuning:profile'))
+    if profile:
+        if profile not in TUNING_PROFILES:
+            raise Error('unknown tuning profile %s, choose from %s' %
+                        (profile, ', '.join(sorted(TUNING_PROFILES))))
+        return profile, 'set in pillar or by the caller'
+    rotational = hw['devs'].values()
+    if rotational and not any(rotational):
+        return 'ssd', 'every data disk is non-rotational'
+    if any(not rot for rot in hw['journal_devs'].values()):
+        return 'hybrid', 'rotational data disks with ssd journals'
+    return 'hdd-dense', 'rotational data disks and journals'
+
+
+def _derive_tuning(profile, hw):
+    '''
+    Return [(option, value, reason)] of one host for a profile, scaled by
+    its cpus and memory per osd and its network speed.
+    '''
+    base = TUNING_PROFILES[profile]
+    osds = max(len(hw['devs']), 1)
+    cpus = hw['num_cpus']
+    mem_per_osd = hw['mem_total'] / osds
+    options = []
+
+    for option, per_cpu in (('osd op threads', 2),
+                            ('filestore op threads', 4)):
+        cap = max(2, cpus * per_cpu // osds)
+        value = min(base[option], cap)
+        options.append((option, value, '%s gives %d, %d cpus for %d osds '
+                        'allow %d' % (profile, base[option], cpus, osds, cap)))
+
+    # min before max: ceph syncs no sooner than min, even past max
+    for option in ('osd disk threads', 'filestore min sync interval',
+                   'filestore max sync interval', 'filestore queue max ops',
+                   'journal max write entries'):
+        options.append((option, base[option], 'from %s' % profile))
+
+    if mem_per_osd < 2048:
+        cache, queue = 256, 10485760
+    elif mem_per_osd < 4096:
+        cache, queue = 512, 104857600
+    else:
+        cache, queue = 1024, 1073741824
+    reason = '%d MB of memory per osd' % mem_per_osd
+    options.append(('osd map cache size', cache, reason))
+    options.append(('filestore queue max bytes', queue, reason))
+
+    for option in ('osd recovery max active', 'osd max backfills'):
+        value = base[option]
+        if hw['nic_speed'] is not None and hw['nic_speed'] < 10000:
+            value = max(1, value // 2)
+            reason = '%s gives %d, halved on a %d Mb/s nic' % (
+                profile, base[option], hw['nic_speed'])
+        else:
+            reason = 'from %s' % profile
+        options.append((option, value, reason))
+    return options
+
+
+def _get_tuning():
+    if 'ceph.tuning' not in __context__:
+        hw = _host_hardware()
+        profile, why = _select_profile(hw)
+        __context__['ceph.tuning'] = _derive_tuning(profile, hw)
+    return __context__['ceph.tuning']
+
+
+def _local_osd_ids():
+    if not os.path.isdir(OSD_PATH):
+        return []
+    prefix = '%s-' % CEPH_CLUSTER
+    return sorted(int(name[len(prefix):]) for name in os.listdir(OSD_PATH)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def _host_sections(options=None):
+    '''
+    The [osd.N] sections of ceph.conf carrying the host's tuning, one per
+    local osd.
+    '''
+    osd_ids = _local_osd_ids()
+    if not osd_ids:
+        return []
+    options = options or _get_tuning()
+    return [{'name': 'osd.{osd_id}'.format(osd_id=osd_id),
+             'options': [(option, value) for option, value, _ in options]}
+            for osd_id in osd_ids]
+
+
+def _apply_tuning(options=None):
+    '''
+    Render ceph.conf again with the tuned [osd.N] sections of every local
+    osd, return True when it changed.
+    '''
+    context = _ceph_conf_context(_get_mon_hostslist(), _get_fsid())
+    context['host_sections'] = _host_sections(options)
+    return _gen_ceph_conf(**context)
+
+
+def tuning(profile=None, apply=False):
+    '''
+    Explain the ceph.conf tuning derived from this host's hardware: the
+    profile (hdd-dense, hybrid or ssd, chosen from the rotational flags of
+    its disks unless nodes:<host>:tuning_profile or ceph:tuning:profile
+    is set) and every value with the reason it was derived. With apply,
+    render ceph.conf with it in the [osd.N] sections of the local osds;
+    new osds get it when ceph.osd starts them. ceph.conf is rendered with
+    the pillar profile whenever it is written, so set a profile in pillar
+    to keep it.
+    CLI Example:
+    .. code-block:: bash
+        salt '*' ceph.tuning
+        salt '*' ceph.tuning profile=ssd
+        salt '*' ceph.tuning apply=True
+    '''
+    hw = _host_hardware()
+    profile, why = _select_profile(hw, profile)
+    options = _derive_tuning(profile, hw)
+    ret = {'data': {
+        'profile': profile,
+        'reason': why,
+        'hardware': hw,
+        'options': [{'option': option, 'value': value, 'reason': reason}
+                    for option, value, reason in options],
+    }}
+    if apply:
+        changed = _apply_tuning(options)
+        ret['data']['ceph_conf'] = 'changed' if changed else 'unchanged'
+        ret['data']['applied'] = [section['name'] for section in
+                                  _host_sections(options)]
+    ret['comment'] = 'Ceph tuning of {host}'.format(host=_get_host())
+    ret['result'] = True
+    return ret
+
+
+"""
+pg planner
+"""
+
+PG_PER_OSD = 100
+PG_REPLICA_SIZE = 3
+PG_MIN = 32
+# most pgs added to a pool per run, splitting is expensive on a live pool
+PG_GROW_STEP = 256
+
+
+def _pg_setting(key, default):
+    return int(__salt__['pillar.get']('ceph:global:%s' % key, default))
+
+
+def _count_osds():
+    '''
+    OSDs known to the cluster, the pillar total before the cluster is up.
+    '''
+    planned = int(__salt__['pillar.get']('ceph:global:total_osd', 0) or 0)
+    try:
+        out, code = command('ceph osd ls')
+    except Exception:
+        return planned
+    if code != 0:
+        return planned
+    return max(planned, len(out.split()))
+
+
+def _nearest_power_of_2(target):
+    '''
+    The power of two nearest to target, the lower one unless it is more
+    than 25% below target as the ceph pg calculator does.
+    '''
+    lower = 2 ** int(math.floor(math.log(max(target, 1), 2)))
+    if lower < target * 0.75:
+        return lower * 2
+    return lower
+
+
+def _pool_shares(pools):
+    '''
+    Fraction of the data expected in each pool: ``share`` (0-1) when given,
+    the rest of the cluster split among the other pools by ``size_gb``,
+    equally for pools without any hint.
+    '''
+    explicit = sum(float(pool['share']) for pool in pools if 'share' in pool)
+    if explicit > 1.0:
+        log.warning('Pool shares add up to %.2f, more than the cluster; '
+                    'pools without a share get no pgs beyond the minimum',
+                    explicit)
+    remaining = max(0.0, 1.0 - explicit)
+    sizes = [float(pool['size_gb']) for pool in pools
+             if 'share' not in pool and 'size_gb' in pool]
+    default_size = sum(sizes) / len(sizes) if sizes else 1.0
+    weights = dict((pool['name'], float(pool.get('size_gb', default_size)))
+                   for pool in pools if 'share' not in pool)
+    total = sum(weights.values())
+    if not total:
+        # every size_gb is 0: no hint left, split equally
+        weights = dict((name, 1.0) for name in weights)
+        total = float(len(weights))
+    shares = {}
+    for pool in pools:
+        if 'share' in pool:
+            shares[pool['name']] = float(pool['share'])
+        else:
+            shares[pool['name']] = remaining * weights[pool['name']] / total
+    return shares
+
+
+def _plan_pgs(pools, osd_num, pg_per_osd, replica_size):
+    plans = []
+    shares = _pool_shares(pools)
+    for pool in pools:
+        size = int(pool.get('size', replica_size))
+        target = osd_num * pg_per_osd * shares[pool['name']] / size
+        pg_num = max(PG_MIN, _nearest_power_of_2(target))
+        plans.append({'name': pool['name'], 'share': shares[pool['name']],
+                      'size': size, 'pg_num': pg_num, 'pgp_num': pg_num})
+    return plans
+
+
+def _default_pg_num():
+    '''
+    pg count of a pool created without an explicit one, written to
+    ceph.conf: an equal share of the budget between the pillar pools.
+    '''
+    pools = __salt__['pillar.get']('ceph:pools') or [{'name': 'rbd'}]
+    osd_num = int(__salt__['pillar.get']('ceph:global:total_osd', 1) or 1)
+    replica_size = _pg_setting('pool_size', PG_REPLICA_SIZE)
+    pg_per_osd = _pg_setting('pg_per_osd', PG_PER_OSD)
+    return _nearest_power_of_2(
+        osd_num * pg_per_osd / float(replica_size * len(pools)))
+
+
+def _get_pool_pg_num(name):
+    out, code = command('ceph osd pool get {name} pg_num'.format(name=name))
+    if code != 0:
+        return None
+    return int(out.split(':')[-1])
+
+
+def pg_plan():
+    '''
+    pg_num of every pool in ceph:pools for the current number of OSDs,
+    with the pgs per OSD it amounts to. Pools take ``share`` or
+    ``size_gb`` and ``size`` (replicas); ceph:global:pg_per_osd and
+    ceph:global:pool_size set the budget and default replica size.
+    CLI Example:
+    .. code-block:: bash
+        salt 'mon1' ceph.pg_plan
+    '''
+    pools = __salt__['pillar.get']('ceph:pools') or []
+    osd_num = max(_count_osds(), 1)
+    pg_per_osd = _pg_setting('pg_per_osd', PG_PER_OSD)
+    plans = _plan_pgs(pools, osd_num, pg_per_osd,
+                      _pg_setting('pool_size', PG_REPLICA_SIZE))
+    for plan in plans:
+        plan['current'] = _get_pool_pg_num(plan['name'])
+    per_osd = sum(max(plan['pg_num'], plan['current'] or 0) * plan['size']
+                  for plan in plans) / float(osd_num)
+    warnings = []
+    if per_osd > pg_per_osd:
+        warnings.append('%.0f pgs per osd over the budget of %d' %
+                        (per_osd, pg_per_osd))
+    for plan in plans:
+        if plan['current'] and plan['current'] > plan['pg_num']:
+            warnings.append('pool %s has %d pgs, more than the %d planned' %
+                            (plan['name'], plan['current'], plan['pg_num']))
+    for warning in warnings:
+        log.warning(warning)
+    return {'osds': osd_num, 'pg_per_osd': per_osd, 'budget': pg_per_osd,
+            'pools': plans, 'warnings': warnings}
+
+
+def _grow_pool(plan, data):
+    step = _pg_setting('pg_step', PG_GROW_STEP)
+    pg_num = min(plan['pg_num'], plan['current'] + step)
+    for key in ('pg_num', 'pgp_num'):
+        fmt_line = 'ceph osd pool set {name} {key} {value}'
+        data.append(command_check_output(fmt_line.format(
+            name=plan['name'], key=key, value=pg_num)))
+    if pg_num < plan['pg_num']:
+        data.append('pool %s grown to %d pgs, run again to reach %d' %
+                    (plan['name'], pg_num, plan['pg_num']))
+
+
 def pool():
     '''
+    Create the pools of ceph:pools with their planned pg count, and grow
+    existing pools towards it, at most ceph:global:pg_step pgs per run.
     CLI Example:
     .. code-block:: bash
         salt '*' ceph.pool
@@ -773,14 +2102,15 @@ def pool():
     ret = {'data': {}}
     data = []
     fmt_line = 'ceph osd pool create {name} {pg_num} {pgp_num}'
-    pools = __salt__['pillar.get']('ceph:pools')
-    osd_num = __salt__['pillar.get']('ceph:global:total_osd')
-    total_pgs = math.pow(2, (math.ceil(math.log(
-                        int(osd_num)*100/3)/math.log(2))))
-    for pool in pools:
-        pool.update({'pg_num': int(total_pgs)})
-        pool.update({'pgp_num': int(total_pgs)})
-        data.append(command_check_output(fmt_line.format(**pool)))
+    plan = pg_plan()
+    for pool in plan['pools']:
+        if pool['current'] is None:
+            data.append(command_check_output(fmt_line.format(**pool)))
+            fmt_size = 'ceph osd pool set {name} size {size}'
+            data.append(command_check_output(fmt_size.format(**pool)))
+        elif pool['current'] < pool['pg_num']:
+            _grow_pool(pool, data)
+    data.extend(plan['warnings'])
     no_out_cmd = 'ceph osd set noout'
     data.append(command_check_output(no_out_cmd))
     ret['data'] = data
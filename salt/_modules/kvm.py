@@ -42,11 +42,7 @@ class StorageError(Exception):
     pass
 
 
-def _gen_vol_xml(**context):
-    '''
-    params: name, host_ips
-    '''
-    cephpool_template = '''<pool type='rbd'>
+CEPHPOOL_TEMPLATE = '''<pool type='rbd'>
   <name>{{ name }}</name>
   <source>
     {% for host_ip in host_ips -%}
@@ -56,9 +52,26 @@ def _gen_vol_xml(**context):
   </source>
 </pool>
 '''
-    jinja_environment = jinja2.Environment()
-    template = jinja_environment.from_string(cephpool_template)
-    return template.render(**context)
+
+_templates = {}
+
+
+def _get_template(source):
+    '''
+    Compile an inline template once per minion process.
+    '''
+    template = _templates.get(source)
+    if template is None:
+        template = _templates[source] = jinja2.Environment().from_string(
+            source)
+    return template
+
+
+def _gen_vol_xml(**context):
+    '''
+    params: name, host_ips
+    '''
+    return _get_template(CEPHPOOL_TEMPLATE).render(**context)
 
 
 def __get_conn():
@@ -94,16 +107,7 @@ def __get_conn():
 
 
 def _get_mon_hostslist():
-    MON_INT = __salt__['pillar.get']('ceph:mon:interface')
-    hosts = []
-    hostsitems = __salt__['mine.get']('roles:ceph-mon',
-                                      'grains.items',
-                                      'grain')
-
-    for _, grains in hostsitems.items():
-        hosts.append(grains['ip_interfaces'][MON_INT][0])
-
-    return hosts
+    return [mon['ip'] for mon in __salt__['ceph.mon_hosts']()]
 
 
 def create_storage_pool(name, host_ips):